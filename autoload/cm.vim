@@ -44,6 +44,12 @@ func! cm#enable_for_buffer()
 		autocmd InsertLeave <buffer> call s:notify_core_channel('cm_insert_leave')
 		autocmd InsertEnter <buffer> call s:change_tick_start()
 		autocmd InsertLeave <buffer> call s:change_tick_stop()
+		if g:cm_refresh_by_event
+			autocmd TextChangedI,CursorMovedI <buffer> call s:on_change_event()
+			if exists('##TextChangedP')
+				autocmd TextChangedP <buffer> call s:on_change_event()
+			endif
+		endif
 		autocmd FileType,BufWinEnter <buffer> call s:check_and_start_all_channels()
 		" save and restore completeopt
 		autocmd BufWinEnter    <buffer> let s:saved_completeopt = &completeopt | set completeopt=menu,menuone,noinsert,noselect
@@ -128,6 +134,7 @@ func! cm#register_source(info)
 	endif
 
 	let s:sources[a:info['name']] = a:info
+	call s:sources_changed(a:info['name'])
 
 	" check and start channels
 	if get(b:,'cm_enable',0) == 0
@@ -143,7 +150,11 @@ func! cm#remove_source(name)
 		let l:info = s:sources[a:name]
 		for l:channel in get(l:info,'channels',[])
 			try
-				if has_key(l:channel,'id')
+				if has_key(l:channel,'host') && has_key(l:channel,'id')
+					" the thread of the shared host stops when its channel
+					" is closed
+					call chanclose(l:channel.id)
+				elseif has_key(l:channel,'id')
 					jobstop(l:channel.id)
 				endif
 			catch
@@ -152,6 +163,7 @@ func! cm#remove_source(name)
 		endfor
 		unlet l:info
 		unlet s:sources[a:name]
+		call s:sources_changed(a:name)
 	catch
 		return
 	endtry
@@ -168,6 +180,9 @@ endfunc
 "	1 ignored for context change
 "   2 async completion has been disabled
 "   3 this source has not been registered yet
+"
+" python channel sources should use `cm.complete` instead, the matches are
+" pushed to the core directly, without going through neovim
 func! cm#complete(src, context, startcol, matches, ...)
 
 	if type(a:src)==1
@@ -191,18 +206,27 @@ func! cm#complete(src, context, startcol, matches, ...)
 		return 3
 	endif
 
-	call call(function('s:notify_core_channel'),['cm_complete',s:sources,l:name,a:context,a:startcol,a:matches]+a:000)
+	call call(function('s:notify_core_channel'),['cm_complete',s:sources_version,l:name,a:context,a:startcol,a:matches]+a:000)
 
 endfunc
 
 " internal functions and variables
 
 let s:sources = {}
+" the core keeps a copy of s:sources, it is kept in sync with the deltas
+" notified by s:sources_changed, the per-keystroke messages only carry the
+" version
+let s:sources_version = 0
+" {'{channel_id}/{source_name}': s:sources_version}, the registry version
+" whose source info has been sent to the channel
+let s:channel_info_version = {}
 let s:leaving = 0
 let s:change_timer = -1
+let s:change_event_timer = -1
 let s:lasttick = ''
 let s:channel_id = -1
 let s:channel_started = 0
+let s:host_id = -1
 let s:core_py_path = globpath(&rtp,'pythonx/cm_core.py')
 " let s:complete_timer
 let s:complete_timer_ctx = {}
@@ -239,7 +263,10 @@ endfunc
 
 " check and start channels
 func! s:check_and_start_channels(info)
-	let a:info['enable'] = get(a:info,'enable',g:cm_sources_enable)
+	if !has_key(a:info,'enable')
+		let a:info['enable'] = g:cm_sources_enable
+		call s:sources_changed(a:info['name'])
+	endif
 	if a:info['enable'] == 0
 		return
 	endif
@@ -260,54 +287,191 @@ func! cm#_start_channels(info)
 
 		if l:channel['type']=='python3'
 
-			if get(l:channel, 'id',-1)!=-1
-				" channel already started
+			if get(l:channel, 'id',-1)!=-1 || has_key(l:channel,'host')
+				" channel already started, or being started by the host
 				continue
 			endif
 
+			if g:cm_shared_host && get(l:channel,'shared',0)
+				" the source runs on a thread of the shared host process, it
+				" connects back with its own channel, see
+				" cm#_channel_started
+				call s:start_host()
+				let l:channel['host'] = s:host_id
+				" the watchdog of the core kills the whole host for a stuck
+				" source, and restarts the sources in it
+				silent! let l:channel['pid'] = jobpid(s:host_id)
+				call rpcnotify(s:host_id,'cm_host_start',l:info['name'],l:channel['path'])
+				continue
+			endif
+
+			if g:cm_zygote && get(l:channel,'zygote',1)
+				" forked from the zygote of the core, it connects back with
+				" its own channel, see cm#_channel_started, which replays
+				" the refresh
+				if s:notify_core_channel('cm_zygote_start',l:info['name'],l:channel['path'])==0
+					let l:channel['host'] = 'zygote'
+					continue
+				endif
+			endif
+
 			" find script path
 			let l:py3 = get(g:,'python3_host_prog','python3')
 
-			let l:opt = {'rpc':1, 'channel': l:channel}
+			let l:opt = {'rpc':1, 'channel': l:channel, 'name': l:info['name']}
 			let l:opt['detach'] = get(l:channel,'detach',0)
 
 			func l:opt.on_exit(job_id, data, event)
-
-				" delete event group
-				execute 'augroup cm_channel_' . self['channel']['id']
-				execute 'autocmd!'
-				execute 'augroup END'
-
-				unlet self['channel']['id']
-				" mark it
-				let self['channel']['has_terminated'] = 1
-				if s:leaving
-					return
-				endif
-				echom self['channel']['path'] . ' ' . 'exit'
-				unlet self['channel']
+				call s:on_channel_exit(self['name'],self['channel'])
 			endfunc
 
 			" start channel
 			let l:channel['id'] = jobstart([l:py3,s:core_py_path,'channel',l:channel['path']],l:opt)
+			silent! unlet l:channel['has_terminated']
+			" for the watchdog of the core
+			silent! let l:channel['pid'] = jobpid(l:channel['id'])
+			call s:channel_events(l:channel)
 
-			" events
-			execute 'augroup cm_channel_' . l:channel['id']
-			for l:event in get(l:channel,'events',[])
-				let l:exec =  'if get(b:,"cm_enable",0) | call rpcnotify(' . l:channel['id'] . ', "cm_event", "'.l:event.'",cm#context()) | endif'
-				if type(l:event)==type('')
-					execute 'au ' . l:event . ' * ' . l:exec
-				elseif type(l:event)==type([])
-					execute 'au ' . join(l:event,' ') .' ' .  l:exec
-				endif
-			endfor
-			execute 'augroup END'
+			let l:started = 1
 
 		endif
 	endfor
+	if get(l:,'started',0)
+		call s:sources_changed(l:info['name'])
+	endif
 	return l:info
 endfunc
 
+func! s:channel_events(channel)
+	execute 'augroup cm_channel_' . a:channel['id']
+	for l:event in get(a:channel,'events',[])
+		let l:exec =  'if get(b:,"cm_enable",0) | call rpcnotify(' . a:channel['id'] . ', "cm_event", "'.l:event.'",cm#context()) | endif'
+		if type(l:event)==type('')
+			execute 'au ' . l:event . ' * ' . l:exec
+		elseif type(l:event)==type([])
+			execute 'au ' . join(l:event,' ') .' ' .  l:exec
+		endif
+	endfor
+	execute 'augroup END'
+endfunc
+
+func! s:on_channel_exit(name,channel)
+	if has_key(a:channel,'id')
+		" delete event group
+		execute 'augroup cm_channel_' . a:channel['id']
+		execute 'autocmd!'
+		execute 'augroup END'
+
+		silent! unlet s:channel_info_version[a:channel['id'] . '/' . a:name]
+		unlet a:channel['id']
+	endif
+	silent! unlet a:channel['host']
+	silent! unlet a:channel['pid']
+	" mark it
+	let a:channel['has_terminated'] = 1
+	call s:sources_changed(a:name)
+	if s:leaving
+		return
+	endif
+	echom a:channel['path'] . ' ' . 'exit'
+endfunc
+
+" shared host process for the python sources, started on demand
+func! s:start_host()
+	if s:host_id!=-1
+		return
+	endif
+	let l:py3 = get(g:,'python3_host_prog','python3')
+	let s:host_id = jobstart([l:py3,s:core_py_path,'host'],{'rpc':1,
+			\ 'on_exit' : function('s:on_host_exit'),
+			\ })
+endfunc
+
+func! s:on_host_exit(job_id, data, event)
+	let s:host_id = -1
+	for l:name in keys(s:sources)
+		for l:channel in get(s:sources[l:name],'channels',[])
+			if get(l:channel,'host',-1) is a:job_id
+				call s:on_channel_exit(l:name,l:channel)
+			endif
+		endfor
+	endfor
+endfunc
+
+" called from the shared host or a source forked by the zygote, when the
+" source has connected to neovim, the pid is only available for the forked
+" source, for the watchdog of the core
+func! cm#_channel_started(name,id,...)
+	for l:channel in get(get(s:sources,a:name,{}),'channels',[])
+		if has_key(l:channel,'host')
+			let l:channel['id'] = a:id
+			silent! unlet l:channel['has_terminated']
+			if a:0
+				let l:channel['pid'] = a:1
+			endif
+			call s:channel_events(l:channel)
+			call s:sources_changed(a:name)
+			call s:replay_refresh()
+			return
+		endif
+	endfor
+endfunc
+
+" the refresh which started a channel is not sent to it, the channel had no
+" id yet, refresh the current context again
+func! s:replay_refresh()
+	if mode()=='i' && (&paste==0)
+		call s:on_changed()
+	endif
+endfunc
+
+" called from the core, when the zygote is not available, start the channel
+" with jobstart instead
+func! cm#_channel_start_failed(name)
+	let l:info = get(s:sources,a:name,{})
+	for l:channel in get(l:info,'channels',[])
+		if get(l:channel,'host','')=='zygote' && !has_key(l:channel,'id')
+			unlet l:channel['host']
+			let l:channel['zygote'] = 0
+		endif
+	endfor
+	if !empty(l:info)
+		call cm#_start_channels(l:info)
+		call s:replay_refresh()
+	endif
+endfunc
+
+" called from the shared host or the core, when the source has stopped
+func! cm#_channel_exited(name)
+	for l:channel in get(get(s:sources,a:name,{}),'channels',[])
+		if has_key(l:channel,'host')
+			call s:on_channel_exit(a:name,l:channel)
+			return
+		endif
+	endfor
+endfunc
+
+" called from the channel sources, when the core is not reachable directly,
+" see cm.refresh_done
+func! cm#_refresh_done(name,ctx,dropped)
+	call s:notify_core_channel('cm_refresh_done',a:name,a:ctx,a:dropped)
+endfunc
+
+" called from cm_core.py, for a full sync when the core has missed some of the
+" deltas, eg. sources registered before the core channel started
+func! cm#_sources()
+	return [s:sources_version, s:sources]
+endfunc
+
+func! s:sources_changed(name)
+	let s:sources_version += 1
+	if has_key(s:sources,a:name)
+		call s:notify_core_channel('cm_sources_changed',s:sources_version,{a:name : s:sources[a:name]},[])
+	else
+		call s:notify_core_channel('cm_sources_changed',s:sources_version,{},[a:name])
+	endif
+endfunc
+
 func! cm#_core_complete(context, startcol, matches)
 
 	if get(b:,'cm_enable',0) == 0
@@ -376,6 +540,16 @@ fun s:on_core_channel_exit(job_id, data, event)
 	echom 'cm-core channel exit'
 endf
 
+func! cm#stats()
+	if s:channel_id==-1
+		echo 'cm-core channel is not running'
+		return
+	endif
+	for l:line in rpcrequest(s:channel_id,'cm_stats')
+		echo l:line
+	endfor
+endfunc
+
 fun s:notify_core_channel(event,...)
 	if s:channel_id==-1
 		return -1
@@ -395,20 +569,47 @@ func! s:change_tick_start()
 		return
 	endif
 	let s:lasttick = s:changetick()
-	" check changes every 30ms, which is 0.03s, it should be fast enough
-	let s:change_timer = timer_start(30,function('s:check_changes'),{'repeat':-1})
+	if !g:cm_refresh_by_event || !exists('##TextChangedP')
+		" Fallback. TextChangedI is not triggered when the popup menu is
+		" visible, check changes every 30ms, which is 0.03s, it should be
+		" fast enough
+		let s:change_timer = timer_start(30,function('s:check_changes'),{'repeat':-1})
+	endif
 	call s:on_changed()
 endfunc
 
 func! s:change_tick_stop()
+	if s:change_event_timer!=-1
+		call timer_stop(s:change_event_timer)
+		let s:change_event_timer = -1
+	endif
+	let s:lasttick = ''
 	if s:change_timer==-1
 		return
 	endif
 	call timer_stop(s:change_timer)
-	let s:lasttick = ''
 	let s:change_timer = -1
 endfunc
 
+" TextChangedI, CursorMovedI and TextChangedP. Coalesce the events of a burst,
+" the zero timer fires after the typeahead has been processed, so there's one
+" check for the whole burst
+func! s:on_change_event()
+	if s:change_event_timer!=-1
+		return
+	endif
+	let s:change_event_timer = timer_start(0,function('s:on_change_event_timer'))
+endfunc
+
+func! s:on_change_event_timer(timer)
+	let s:change_event_timer = -1
+	if type(s:lasttick)!=type([])
+		" not in insert mode
+		return
+	endif
+	call s:check_changes(a:timer)
+endfunc
+
 
 func! s:check_changes(timer)
 	let l:tick = s:changetick()
@@ -417,6 +618,10 @@ func! s:check_changes(timer)
 		if mode()=='i' && (&paste==0)
 			" only in insert non paste mode
 			call s:on_changed()
+		elseif get(b:,'cm_enable',0)
+			" not refreshing, the core needs the tick for outdating the
+			" replies of the sources
+			call s:notify_core_channel('cm_context',l:tick)
 		endif
 	endif
 endfunc
@@ -435,25 +640,35 @@ func! s:on_changed()
 
 	let l:ctx = cm#context()
 
-	call s:notify_core_channel('cm_refresh',s:sources,l:ctx)
+	call s:notify_core_channel('cm_refresh',s:sources_version,l:ctx)
 
 	" TODO
 	" detect popup item selected event then notify sources
 
 endfunc
 
-func! cm#_notify_sources_to_refresh(calls, channels, ctx)
+" a:delay is decided by the core, according to the latency history of the
+" sources, at most g:cm_complete_delay
+func! cm#_notify_sources_to_refresh(calls, channels, ctx, delay)
 
 	if exists('s:complete_timer')
 		call timer_stop(s:complete_timer)
 		unlet s:complete_timer
 	endif
-	let s:complete_timer = timer_start(g:cm_complete_delay,function('s:complete_timeout'))
+	let s:complete_timer = timer_start(a:delay,function('s:complete_timeout'))
 	let s:complete_timer_ctx = a:ctx
 
+	" contexts targeting the same channel are batched by the core, the channel
+	" caches the source info, only send it again if the registry has changed
 	for l:channel in a:channels
 		try
-			call rpcnotify(l:channel['id'], 'cm_refresh', s:sources[l:channel['name']], l:channel['context'])
+			let l:info = {}
+			let l:key = l:channel['id'] . '/' . l:channel['name']
+			if get(s:channel_info_version,l:key,-1)!=s:sources_version
+				let l:info = s:sources[l:channel['name']]
+				let s:channel_info_version[l:key] = s:sources_version
+			endif
+			call rpcnotify(l:channel['id'], 'cm_refresh_batch', l:channel['name'], l:info, l:channel['contexts'])
 		catch
 			continue
 		endtry
@@ -502,7 +717,7 @@ func! s:complete_timeout(timer)
 	if cm#context_changed(s:complete_timer_ctx)
 		return
 	endif
-	call s:notify_core_channel('cm_complete_timeout',s:sources,s:complete_timer_ctx)
+	call s:notify_core_channel('cm_complete_timeout',s:sources_version,s:complete_timer_ctx)
 endfunc
 
 func! s:menu_selected()
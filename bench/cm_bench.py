@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+
+# Headless latency benchmark for the completion pipeline.
+#
+# It drives cm_core.CoreHandler and completion sources against a stub neovim
+# object, replays synthetic typing sessions, and reports the latency from
+# keystroke to cm#_core_complete, allocations and throughput as json, for
+# comparing commits:
+#
+#   python3 bench/cm_bench.py -o before.json
+#   python3 bench/cm_bench.py --sources 1,10 --matches 1000 --scenario prefix
+#
+# The neovim python client is required, since cm_core imports it.
+
+import os
+import sys
+import re
+import json
+import time
+import glob
+import random
+import string
+import logging
+import argparse
+import platform
+import subprocess
+import threading
+import tracemalloc
+from collections import deque
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'pythonx'))
+
+import cm_core
+from cm import cm
+from cm.sources import cm_bufkeyword
+
+logger = logging.getLogger(__name__)
+
+
+class StubBuffer:
+
+    def __init__(self):
+        self.lines = ['']
+
+    def __getitem__(self, idx):
+        return self.lines[idx]
+
+
+class StubCurrent:
+
+    def __init__(self):
+        self.buffer = StubBuffer()
+
+
+class StubNvim:
+    """
+    Implements the subset of the neovim api used by the core, the file server,
+    and the sources. Notifications to the core are queued, like the messages
+    in the rpc channel, and delivered by `Session.drain`.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self.current = StubCurrent()
+        self.vars = {
+            'g:cm_complete_delay': 50,
+            'g:cm_matcher': {'module': 'cm.cm', 'name': 'prefix_matcher'},
+            'g:cm_sorter': {'module': 'cm.cm', 'name': 'alnum_match_sorter'},
+            'g:cm_matches_max': 256,
+            'g:cm_buffer_cache_size': 16 * 1024 * 1024,
+            'g:cm_zygote': 0,
+            'g:cm_refresh_deadline': 10000,
+            'v:servername': '/tmp/cm-bench-nvim',
+        }
+
+    def eval(self, expr):
+        if expr.startswith("globpath(&rtp,'pythonx/cm/scopers/*.py')"):
+            return "\n".join(glob.glob(os.path.join(root, 'pythonx/cm/scopers/*.py')))
+        if expr.startswith("globpath(&rtp,'pythonx/cm/sources/*.py')"):
+            # the bench sources are registered by the session
+            return ''
+        if expr == 'cm#context()':
+            return self._session.context()
+        return self.vars[expr]
+
+    def call(self, method, *args, **kwargs):
+        return getattr(self._session, 'vim_' + method.replace('#', '_'))(*args)
+
+    def async_call(self, fn, *args):
+        # from the CompleteServer thread
+        self._session.post(fn, args)
+
+
+class StubFileServerNvim(StubNvim):
+    """
+    The connection of the file server, its event loop runs on another thread,
+    the buffer events are sent by `Session.set_buffer`
+    """
+
+    def __init__(self, session):
+        StubNvim.__init__(self, session)
+        self.current = session.nvim.current
+        self.on_notification = None
+        self.attached = set()
+        self._stopped = threading.Event()
+
+    def run_loop(self, request_cb, notification_cb, setup_cb=None):
+        self.on_notification = notification_cb
+        self._stopped.wait()
+
+    def stop_loop(self):
+        self._stopped.set()
+
+    def async_call(self, fn, *args):
+        fn(*args)
+
+    def request(self, method, *args):
+        if method == 'nvim_buf_attach':
+            bufnr = args[0]
+            self.attached.add(bufnr)
+            self.on_notification('nvim_buf_lines_event',
+                                 [bufnr, self._session.changedtick, 0, -1, list(self.current.buffer.lines), False])
+            return True
+        if method == 'nvim_buf_detach':
+            self.attached.discard(args[0])
+            self.on_notification('nvim_buf_detach_event', [args[0]])
+            return True
+        if method == 'nvim_buf_get_var' and args[1] == 'changedtick':
+            return self._session.changedtick
+        if method == 'nvim_buf_get_lines':
+            return list(self.current.buffer.lines)
+        raise Exception('not implemented: %s' % method)
+
+
+class SyntheticSource:
+    """
+    A channel source replying `size` keywords for every refresh, similar to
+    cm-bufkeyword and cm-tmux
+    """
+
+    def __init__(self, session, words):
+        self._session = session
+        self._nvim = session.nvim
+        self._words = words
+
+    def cm_refresh(self, info, ctx, *args):
+        typed = ctx['typed']
+        kw = re.search(r'[0-9a-zA-Z_]*?$', typed).group(0)
+        startcol = ctx['col'] - len(kw)
+        self._session.replies_sent += 1
+        cm.complete(self._nvim, info['name'], ctx, startcol, self._words)
+
+
+class BufKeywordSource:
+    """
+    The bundled cm-bufkeyword source, the words are collected from the buffer
+    by the source itself, the generated words are not used
+    """
+
+    def __init__(self, session, words):
+        self._session = session
+        self._source = cm_bufkeyword.Source(session.nvim)
+        self._entered = False
+
+    def cm_refresh(self, info, ctx, *args):
+        # the events neovim would send before the refresh
+        if not self._entered:
+            self._entered = True
+            self._source.cm_event('BufEnter', ctx)
+        else:
+            self._source.cm_event('TextChangedI', ctx)
+        self._session.replies_sent += 1
+        self._source.cm_refresh(info, ctx)
+
+
+class Session:
+    """
+    One neovim instance with a core and some sources
+    """
+
+    def __init__(self, sources, matches, matcher, seed=0, source_class=SyntheticSource):
+
+        self._rand = random.Random(seed)
+        self.nvim = StubNvim(self)
+        if matcher == 'fuzzy':
+            self.nvim.vars['g:cm_matcher'] = {'module': 'cm.cm', 'name': 'fuzzy_matcher'}
+            self.nvim.vars['g:cm_sorter'] = {'module': 'cm.cm', 'name': 'score_sorter'}
+
+        self._ctx = None
+        self.changedtick = 1
+        self._queue = deque()
+        self._cond = threading.Condition()
+        # the replies of the sources go through the CompleteServer thread
+        self.replies_sent = 0
+        self._replies_received = 0
+        self._next_channel_id = 100
+        self._completes = []
+        self._timer = None
+
+        self.sources = {}
+        self.sources_version = 1
+        self._handlers = {}
+        for i in range(sources):
+            name = 'bench-%s' % i
+            # every other source is python specific, for the scoping sessions
+            scopes = ['python'] if i % 2 else ['*']
+            self.sources[name] = dict(name=name, priority=9 - i % 5, abbreviation='B%s' % i,
+                                      scopes=scopes, enable=1,
+                                      channels=[dict(type='python3', path=name)])
+            words = [self._word() for _ in range(matches)]
+            self._handlers[name] = source_class(self, words)
+
+        # the file server connects to neovim with another channel
+        self.file_server_nvim = StubFileServerNvim(self)
+        cm_core.attach = lambda *args, **kwargs: self.file_server_nvim
+        self.core = cm_core.CoreHandler(self.nvim)
+
+    def _word(self):
+        parts = [''.join(self._rand.choice(string.ascii_lowercase) for _ in range(self._rand.randint(2, 6)))
+                 for _ in range(self._rand.randint(1, 3))]
+        return '_'.join(parts)
+
+    def shutdown(self):
+        self.core.cm_shutdown()
+
+    # neovim side
+
+    def context(self):
+        return dict(self._ctx)
+
+    def set_buffer(self, lines, lnum, col, filetype):
+        old = self.nvim.current.buffer.lines
+        self.nvim.current.buffer.lines = lines
+        self.changedtick += 1
+        if 1 in self.file_server_nvim.attached:
+            # the changed lines
+            first = 0
+            while first < min(len(old), len(lines)) and old[first] == lines[first]:
+                first += 1
+            last = 0
+            while (last < min(len(old), len(lines)) - first
+                   and old[len(old) - 1 - last] == lines[len(lines) - 1 - last]):
+                last += 1
+            self.file_server_nvim.on_notification('nvim_buf_lines_event',
+                                                  [1, self.changedtick, first, len(old) - last,
+                                                   lines[first:len(lines) - last], False])
+        typed = lines[lnum - 1][:col - 1]
+        self._ctx = dict(bufnr=1, curpos=[0, lnum, col, 0], changedtick=self.changedtick,
+                         lnum=lnum, col=col, filetype=filetype, filepath='/tmp/bench.' + filetype,
+                         typed=typed)
+
+    def vim_cm_register_source(self, info):
+        pass
+
+    def vim_cm_context(self):
+        return self.context()
+
+    def vim_cm__start_channels(self, name):
+        info = self.sources[name]
+        for channel in info['channels']:
+            if 'id' not in channel:
+                channel['id'] = self._next_channel_id
+                self._next_channel_id += 1
+        self.sources_version += 1
+        return info
+
+    def vim_cm__sources(self):
+        return [self.sources_version, self.sources]
+
+    def vim_cm__notify_sources_to_refresh(self, calls, channels, ctx, delay):
+        self._timer = (dict(ctx), delay)
+        for channel in channels:
+            for sub_ctx in channel['contexts']:
+                self.post(self._handlers[channel['name']].cm_refresh,
+                          (self.sources[channel['name']], sub_ctx), reply=False)
+
+    def vim_cm_complete(self, name, ctx, startcol, matches, *args):
+        if cm.context_outdated(self._ctx, ctx):
+            self.post(lambda: None, ())
+            return 1
+        self.post(self.core.cm_complete, (self.sources_version, name, ctx, startcol, matches) + args)
+        return 0
+
+    def vim_cm__core_complete(self, ctx, startcol, matches):
+        self._completes.append((time.perf_counter(), len(matches)))
+
+    # message loop
+
+    def keystroke(self):
+        """
+        Notify the core and deliver all the resulting messages, return the
+        latency of the first and the last cm#_core_complete call in seconds,
+        and the number of items in the last popup.
+        """
+        self._completes = []
+        self._timer = None
+        start = time.perf_counter()
+        self.core.cm_refresh(self.sources_version, self.context())
+        self.drain()
+        if self._timer:
+            # the popup timer, the bench doesn't wait for the real delay
+            ctx, delay = self._timer
+            if not cm.context_outdated(self._ctx, ctx):
+                self.core.cm_complete_timeout(self.sources_version, ctx)
+            self.drain()
+        if not self._completes:
+            return None
+        return (self._completes[0][0] - start, self._completes[-1][0] - start, self._completes[-1][1])
+
+    def post(self, func, args, reply=True):
+        with self._cond:
+            self._queue.append((func, args))
+            if reply:
+                self._replies_received += 1
+            self._cond.notify()
+
+    def drain(self):
+        while True:
+            with self._cond:
+                while not self._queue and self._replies_received < self.replies_sent:
+                    if not self._cond.wait(5):
+                        raise RuntimeError('replies of the sources are lost')
+                if not self._queue:
+                    return
+                func, args = self._queue.popleft()
+            func(*args)
+
+
+# typing sessions, yield (lines, lnum, col, filetype) for each keystroke
+
+def scenario_prefix(rand, words):
+    """
+    typing words, with spaces between them
+    """
+    line = ''
+    for word in words:
+        for c in word:
+            line += c
+            yield [line], 1, len(line) + 1, 'python'
+        line += ' '
+        yield [line], 1, len(line) + 1, 'python'
+
+
+def scenario_backspace(rand, words):
+    """
+    typing words, and deleting some characters from time to time
+    """
+    line = ''
+    for word in words:
+        for c in word:
+            line += c
+            yield [line], 1, len(line) + 1, 'python'
+            if rand.random() < 0.3:
+                line = line[:-1]
+                yield [line], 1, len(line) + 1, 'python'
+        line += ' '
+        yield [line], 1, len(line) + 1, 'python'
+
+
+def scenario_markdown(rand, words):
+    """
+    typing in a markdown document, in the prose and in a python code fence,
+    the cursor jumps between them
+    """
+    prose = ['# title', ''] + [' '.join(words[:8])] * 200 + ['']
+    fence = ['```python', 'import os', '', '```']
+    after = [''] + [' '.join(words[:8])] * 200
+    prose_line = ''
+    code_line = ''
+    for i, word in enumerate(words):
+        inside = i % 2
+        for c in word:
+            if inside:
+                code_line += c
+            else:
+                prose_line += c
+            lines = prose + [prose_line] + fence[:2] + [code_line] + fence[2:] + after
+            if inside:
+                yield lines, len(prose) + 4, len(code_line) + 1, 'markdown'
+            else:
+                yield lines, len(prose) + 1, len(prose_line) + 1, 'markdown'
+        if inside:
+            code_line += ' '
+        else:
+            prose_line += ' '
+
+
+def scenario_bufkeyword(rand, words):
+    """
+    typing words at the end of a document containing them, completed by the
+    real cm-bufkeyword source
+    """
+    document = [' '.join(words[i:i + 8]) for i in range(0, len(words), 8)] * 20 + ['']
+    line = ''
+    for word in rand.sample(words, len(words)):
+        for c in word:
+            line += c
+            yield document + [line], len(document) + 1, len(line) + 1, 'python'
+        line += ' '
+        yield document + [line], len(document) + 1, len(line) + 1, 'python'
+
+
+scenarios = {
+    'prefix': scenario_prefix,
+    'backspace': scenario_backspace,
+    'markdown': scenario_markdown,
+    'bufkeyword': scenario_bufkeyword,
+}
+
+# the sources of the scenarios, SyntheticSource by default
+scenario_sources = {
+    'bufkeyword': BufKeywordSource,
+}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(scenario, sources, matches, matcher, keys, alloc, seed=0):
+
+    rand = random.Random(seed)
+    session = Session(sources, matches, matcher, seed, scenario_sources.get(scenario, SyntheticSource))
+    words = [session._word() for _ in range(keys)]
+
+    strokes = []
+    for stroke in scenarios[scenario](rand, words):
+        strokes.append(stroke)
+        if len(strokes) >= keys:
+            break
+
+    first = []
+    last = []
+    items = []
+    alloc_peaks = []
+    try:
+        start = time.perf_counter()
+        for lines, lnum, col, filetype in strokes:
+            session.set_buffer(lines, lnum, col, filetype)
+            ret = session.keystroke()
+            if ret:
+                first.append(ret[0])
+                last.append(ret[1])
+                items.append(ret[2])
+        elapsed = time.perf_counter() - start
+
+        if alloc:
+            # a separate pass, tracemalloc slows down everything
+            tracemalloc.start()
+            for lines, lnum, col, filetype in strokes:
+                session.set_buffer(lines, lnum, col, filetype)
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                base, _ = tracemalloc.get_traced_memory()
+                session.keystroke()
+                _, peak = tracemalloc.get_traced_memory()
+                alloc_peaks.append(peak - base)
+            tracemalloc.stop()
+    finally:
+        session.shutdown()
+
+    def ms(v):
+        return None if v is None else round(v * 1000, 3)
+
+    return dict(
+        scenario=scenario,
+        sources=sources,
+        matches=matches,
+        matcher=matcher,
+        keystrokes=len(strokes),
+        popups=len(last),
+        popup_items_avg=round(sum(items) / len(items), 1) if items else 0,
+        first_popup_ms=dict(p50=ms(percentile(first, 50)), p95=ms(percentile(first, 95)),
+                            p99=ms(percentile(first, 99)), max=ms(max(first) if first else None)),
+        last_popup_ms=dict(p50=ms(percentile(last, 50)), p95=ms(percentile(last, 95)),
+                           p99=ms(percentile(last, 99)), max=ms(max(last) if last else None)),
+        keystrokes_per_sec=round(len(strokes) / elapsed, 1) if elapsed else None,
+        alloc_peak_kb=dict(p50=round(percentile(alloc_peaks, 50) / 1024, 1),
+                           max=round(max(alloc_peaks) / 1024, 1)) if alloc_peaks else None,
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='headless latency benchmark of the completion pipeline')
+    parser.add_argument('--scenario', default='all', help='%s or all' % ','.join(sorted(scenarios)))
+    parser.add_argument('--sources', default='1,3,10', help='numbers of sources, comma separated')
+    parser.add_argument('--matches', default='100,1000', help='numbers of matches per source, comma separated')
+    parser.add_argument('--matcher', default='prefix', choices=['prefix', 'fuzzy'])
+    parser.add_argument('--keys', type=int, default=200, help='keystrokes per run')
+    parser.add_argument('--no-alloc', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('-o', '--output', help='write json to this file instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the core')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    if args.scenario == 'all':
+        names = sorted(scenarios)
+    else:
+        names = args.scenario.split(',')
+
+    results = []
+    for name in names:
+        for sources in [int(e) for e in args.sources.split(',')]:
+            for matches in [int(e) for e in args.matches.split(',')]:
+                result = run(name, sources, matches, args.matcher, args.keys, not args.no_alloc)
+                results.append(result)
+                print('%-10s sources %3s matches %5s: last popup p50 %sms p95 %sms, %s keys/s' % (
+                    name, sources, matches, result['last_popup_ms']['p50'],
+                    result['last_popup_ms']['p95'], result['keystrokes_per_sec']), file=sys.stderr)
+
+    report = dict(commit=git_commit(), python=platform.python_version(), time=time.time(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
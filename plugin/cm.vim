@@ -4,13 +4,58 @@ if get(g:,'cm_enable_for_all',1)
 	au BufWinEnter * if (exists('b:cm_enable')==0 && line2byte(line("$") + 1)<1000000) | call cm#enable_for_buffer() | endif
 endif
 
+" latency percentiles of each stage and each source
+command! -nargs=0 CmStats call cm#stats()
+
 
 " wait for a while before popping up, in milliseconds, this would reduce the
 " popup menu flashes when multiple sources are updating the popup menu in a
 " short interval, use a interval which is long enough for computer and short
-" enough for human
+" enough for human. This is the max delay, the popup shows earlier if the
+" sources which usually reply in time have replied, and it doesn't wait for
+" the sources known to be slow.
 let g:cm_complete_delay = get(g:,'cm_complete_delay',50)
 
+" how the candidates are filtered and sorted, functions of the python module,
+" taking cm.Match records.
+" For fuzzy matching:
+"	let g:cm_matcher = {'module': 'cm.cm', 'name': 'fuzzy_matcher'}
+"	let g:cm_sorter = {'module': 'cm.cm', 'name': 'score_sorter'}
+let g:cm_matcher = get(g:,'cm_matcher',{'module': 'cm.cm', 'name': 'prefix_matcher'})
+let g:cm_sorter = get(g:,'cm_sorter',{'module': 'cm.cm', 'name': 'alnum_match_sorter'})
+
+" max number of items in the popup menu, the matches of all sources are
+" merged, by score and then priority for score_sorter, by priority for other
+" sorters, set it to 0 for no limit
+let g:cm_matches_max = get(g:,'cm_matches_max',256)
+
+" detect changes with the TextChangedI, CursorMovedI and TextChangedP events.
+" Without TextChangedP, which is not available in older versions of neovim, a
+" 30ms timer is still used to detect changes when the popup menu is visible.
+" Set this to 0 for detecting changes with the timer only.
+let g:cm_refresh_by_event = get(g:,'cm_refresh_by_event',1)
+
+" max size of the buffer sources cached by the core for the completion
+" sources, in characters, the least recently used buffers are evicted
+let g:cm_buffer_cache_size = get(g:,'cm_buffer_cache_size',16*1024*1024)
+
+" run the python sources in one shared host process, each source on its own
+" thread with its own channel, instead of one process per source. Sources
+" registered with `shared=0`, eg. cm-jedi, still run in their own process.
+" A source stuck in the host takes the host down with it when the watchdog
+" kills it, the other sources are restarted on demand.
+let g:cm_shared_host = get(g:,'cm_shared_host',0)
+
+" fork the python source channels from a zygote process started by the core,
+" which has the common modules imported already, instead of starting a new
+" interpreter for each of them. Not available on windows.
+let g:cm_zygote = get(g:,'cm_zygote',0)
+
+" deadline of the refreshes of the python sources, in milliseconds, a source
+" not responding in time, eg. stuck in an infinite loop, is killed and
+" restarted with backoff. Set it to 0 to disable the watchdog.
+let g:cm_refresh_deadline = get(g:,'cm_refresh_deadline',10000)
+
 " automatically enable all sources
 " set this to 0 if you want to select sources manually
 let g:cm_sources_enable = get(g:,'cm_sources_enable',1)
@@ -3,10 +3,16 @@ import logging
 import urllib
 import http.client
 import copy
+import json
+import socket
+import threading
+import bisect
+from collections import deque, OrderedDict
+from operator import attrgetter
 
 logger = logging.getLogger(__name__)
 
-def register_source(name,abbreviation,priority,scopes=None,cm_refresh_patterns=None,events=[],detach=0):
+def register_source(name,abbreviation,priority,scopes=None,cm_refresh_patterns=None,events=[],detach=0,shared=1):
     # implementation is put inside cm_core
     # 
     # cm_core use a trick to only register the source withou loading the entire
@@ -17,40 +23,664 @@ def context_outdated(ctx1,ctx2):
     # same as cm#context_changed
     return ctx1 is None or ctx2 is None or ctx1['changedtick']!=ctx2['changedtick'] or ctx1['curpos']!=ctx2['curpos']
 
-def get_src(ctx):
-    src_uri = ctx['src_uri']
-    parsed = urllib.parse.urlparse(src_uri)
-    logger.info('hostname: %s, port %s, path: %s', parsed.hostname, parsed.port, parsed.path)
-    conn = http.client.HTTPConnection(parsed.hostname, parsed.port)
-    try:
-        conn.request("GET", src_uri)
-        res = conn.getresponse()
-        src = res.read().decode('utf-8')
-        res.close()
-        return src
-    finally:
-        conn.close()
-    return None
+class UnixConnection:
+    """
+    Persistent connection to a unix socket of the core, reconnects when the
+    address changes, eg. the core is restarted. Thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sock = None
+        self._rfile = None
+        self._addr = None
+
+    def send(self,addr,data):
+        with self._lock:
+            try:
+                self._connect(addr)
+                self._sock.sendall(data)
+            except:
+                self._close()
+                raise
+
+    def request(self,addr,data):
+        """
+        Send data, and read the reply of a json header line, followed by
+        `length` bytes of body. Return (header, body).
+        """
+        with self._lock:
+            try:
+                self._connect(addr)
+                self._sock.sendall(data)
+                line = self._rfile.readline()
+                if not line:
+                    raise ConnectionError('connection closed by %s' % addr)
+                header = json.loads(line.decode('utf-8'))
+                body = self._rfile.read(header.get('length',0))
+                return header, body
+            except:
+                self._close()
+                raise
+
+    def _connect(self,addr):
+        if self._addr==addr:
+            return
+        self._close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(addr)
+        self._sock = sock
+        self._rfile = sock.makefile('rb')
+        self._addr = addr
+
+    def _close(self):
+        if self._sock:
+            self._rfile.close()
+            self._sock.close()
+        self._sock = None
+        self._rfile = None
+        self._addr = None
+
+# persistent connections to the CompleteServer and the FileServer of the core
+_complete_conn = UnixConnection()
+_src_conn = UnixConnection()
+
+def complete(nvim,name,ctx,startcol,matches,refresh=0,token=None):
+    """
+    Send the matches to the core. The matches are pushed to the core directly
+    if `ctx['complete_addr']` is available, without neovim decoding and
+    re-encoding them. Fallback to cm#complete. Nothing is sent if the
+    CancelToken of the refresh is cancelled.
+    """
+    if token is not None and token.cancelled:
+        logger.info('refresh cancelled, dropping the matches of [%s]', name)
+        return
+    addr = ctx.get('complete_addr',None)
+    if addr:
+        msg = json.dumps(['cm_complete',[name,ctx,startcol,matches,refresh]]) + "\n"
+        try:
+            _complete_conn.send(addr,msg.encode('utf-8'))
+            return
+        except Exception as ex:
+            logger.exception('sending matches to %s failed, fallback to cm#complete: %s', addr, ex)
+
+    # may be called on the thread of RefreshWorker
+    nvim.async_call(lambda: nvim.call('cm#complete', name, ctx, startcol, matches, refresh, async=True))
+
+def refresh_done(nvim,name,ctx,dropped=0):
+    """
+    Acknowledge the refresh of ctx to the watchdog of the core, a source not
+    responding in time is restarted. The event loop of the channel does it
+    for the sources, after cm_refresh returns. dropped is 1 for a refresh
+    dropped without being computed.
+    """
+    ack = dict(changedtick=ctx['changedtick'],curpos=ctx['curpos'])
+    addr = ctx.get('complete_addr',None)
+    if addr:
+        msg = json.dumps(['cm_refresh_done',[name,ack,dropped]]) + "\n"
+        try:
+            _complete_conn.send(addr,msg.encode('utf-8'))
+            return
+        except Exception as ex:
+            logger.exception('sending refresh_done to %s failed, fallback to cm#_refresh_done: %s', addr, ex)
+
+    nvim.async_call(lambda: nvim.call('cm#_refresh_done', name, ack, dropped, async=True))
+
+class Cancelled(Exception):
+    """
+    Raised by CancelToken for a refresh outdated by a newer one
+    """
+    pass
+
+class CancelToken:
+    """
+    Cancellation of a refresh run by RefreshWorker, it's cancelled when a
+    newer context arrives. The source checks it between the steps of the
+    calculation, and runs the blocking calls through it, so that they are
+    killed or abandoned on cancellation.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as ex:
+                logger.exception('cancel callback failed: %s', ex)
+
+    def check(self):
+        """
+        Raise Cancelled if cancelled
+        """
+        if self._event.is_set():
+            raise Cancelled()
+
+    def on_cancel(self,callback):
+        """
+        callback is called on cancellation, or now if already cancelled.
+        Return a function for removing it.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self,callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def communicate(self,proc,input=None,timeout=None):
+        """
+        proc.communicate, the process is killed on cancellation
+        """
+        remove = self.on_cancel(proc.kill)
+        try:
+            result = proc.communicate(input,timeout=timeout)
+        finally:
+            remove()
+        self.check()
+        return result
+
+    def call(self,fn,*args):
+        """
+        Run fn on another thread, eg. a http request, and return its result,
+        it's abandoned on cancellation
+        """
+        result = {}
+        done = threading.Event()
+        def run():
+            try:
+                result['value'] = fn(*args)
+            except Exception as ex:
+                result['error'] = ex
+            finally:
+                done.set()
+        remove = self.on_cancel(done.set)
+        try:
+            threading.Thread(target=run,daemon=True).start()
+            done.wait()
+        finally:
+            remove()
+        self.check()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+class RefreshWorker:
+    """
+    Runs the cm_refresh of a heavy source on a worker thread, so that the
+    event loop is free to receive the newer contexts. A new context cancels
+    the refreshes of the outdated ones, the running one with its CancelToken,
+    and the queued ones are dropped. The contexts of the same batch, which
+    share the root context, are run in turn. The refreshes are acknowledged
+    to the core when they're finished or dropped, cm_refresh returns the
+    token so that the event loop doesn't acknowledge it early.
+
+        self._worker = cm.RefreshWorker(nvim, self.refresh)
+
+        def cm_refresh(self,info,ctx,*args):
+            return self._worker.submit(info,ctx)
+
+        def refresh(self,info,ctx,token):
+            ...
+            cm.complete(self._nvim, info['name'], ctx, startcol, matches, token=token)
+    """
+
+    def __init__(self,nvim,refresh):
+        self._nvim = nvim
+        self._refresh = refresh
+        self._cond = threading.Condition()
+        # [(info, ctx, token)]
+        self._pending = deque()
+        self._running = None
+        self._thread = threading.Thread(target=self._run,daemon=True)
+        self._thread.start()
+
+    def submit(self,info,ctx):
+        token = CancelToken()
+        with self._cond:
+            if self._running and context_outdated(self._running[1],ctx):
+                self._running[2].cancel()
+            for e in list(self._pending):
+                if context_outdated(e[1],ctx):
+                    logger.info('dropping outdated refresh: %s', e[1])
+                    self._pending.remove(e)
+                    refresh_done(self._nvim,e[0]['name'],e[1],1)
+            self._pending.append((info,ctx,token))
+            self._cond.notify()
+        return token
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                self._running = self._pending.popleft()
+            info, ctx, token = self._running
+            try:
+                self._refresh(info,ctx,token)
+            except Cancelled:
+                logger.info('refresh cancelled: %s', ctx)
+            except Exception as ex:
+                logger.exception('refresh failed: %s', ex)
+            finally:
+                with self._cond:
+                    self._running = None
+                refresh_done(self._nvim,info['name'],ctx)
+
+# the last few snapshots read by get_src, { query key: (etag, src) }
+_src_cache = OrderedDict()
+_src_cache_lock = threading.Lock()
+_src_cache_size = 8
+
+def get_src(ctx,lines=None,byte_range=None):
+    """
+    Read the source of the context from the FileServer of the core, through
+    the unix socket `ctx['src_addr']` if available, otherwise the http
+    `ctx['src_uri']`. The snapshot is cached, and not transferred again if
+    the buffer is not modified since the last read.
+    @param lines  [first, last], 1 based and inclusive, relative to the
+                  scope, eg. `[ctx['lnum']-100, ctx['lnum']+100]` for the
+                  lines around the cursor
+    @param byte_range  [start, end] of the utf-8 encoded scope
+    """
+    # the same fields as the src_uri query
+    params = dict(context=dict((k,ctx[k]) for k in ['bufnr','changedtick','curpos','scope_offset','scope_len'] if k in ctx))
+    key = (ctx.get('bufnr'),ctx.get('scope_offset'),ctx.get('scope_len'))
+    return _fetch_src(ctx,params,key,lines,byte_range,ctx['src_uri'])
+
+def get_buffer_src(ctx,bufnr,lines=None,byte_range=None):
+    """
+    Read the latest source of any buffer from the FileServer of the core,
+    the context is only used for the addresses of the FileServer. The lines
+    and byte_range are the same as get_src, relative to the buffer.
+    """
+    parsed = urllib.parse.urlparse(ctx['src_uri'])
+    src_uri = urllib.parse.urlunparse(parsed._replace(query=urllib.parse.urlencode(dict(bufnr=bufnr))))
+    return _fetch_src(ctx,dict(bufnr=bufnr),('buffer',bufnr),lines,byte_range,src_uri)
+
+def _fetch_src(ctx,params,key,lines,byte_range,src_uri):
+    key = key + (lines and tuple(lines),byte_range and tuple(byte_range))
+    with _src_cache_lock:
+        etag, cached = _src_cache.get(key,(None,None))
+
+    addr = ctx.get('src_addr',None)
+    src = None
+    if addr:
+        params = dict(params)
+        if lines:
+            params['lines'] = lines
+        if byte_range:
+            params['bytes'] = byte_range
+        if etag:
+            params['etag'] = etag
+        try:
+            header, body = _src_conn.request(addr,(json.dumps(params)+"\n").encode('utf-8'))
+            if 'error' in header:
+                raise Exception(header['error'])
+            if header.get('not_modified',0):
+                return cached
+            src = body.decode('utf-8')
+            new_etag = header.get('etag',None)
+        except Exception as ex:
+            logger.exception('reading src from %s failed, fallback to src_uri: %s', addr, ex)
+
+    if src is None:
+        if lines:
+            src_uri += '&' + urllib.parse.urlencode(dict(lines=json.dumps(lines)))
+        if byte_range:
+            src_uri += '&' + urllib.parse.urlencode(dict(bytes=json.dumps(byte_range)))
+        parsed = urllib.parse.urlparse(src_uri)
+        logger.info('hostname: %s, port %s, path: %s', parsed.hostname, parsed.port, parsed.path)
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port)
+        try:
+            conn.request("GET", src_uri, headers={'If-None-Match': etag} if etag else {})
+            res = conn.getresponse()
+            body = res.read()
+            res.close()
+            if res.status==304:
+                return cached
+            src = body.decode('utf-8')
+            new_etag = res.getheader('ETag',None)
+        finally:
+            conn.close()
+
+    # no etag for outdated context
+    if new_etag:
+        with _src_cache_lock:
+            _src_cache[key] = (new_etag,src)
+            _src_cache.move_to_end(key)
+            while len(_src_cache)>_src_cache_size:
+                _src_cache.popitem(last=False)
+    return src
+
+class LineIndex:
+    """
+    Offsets of the line starts of a source snapshot, for O(log n)
+    conversions between (lnum, col), the character offset, and the utf-8 byte
+    offset. lnum and col are 1 based, col is counted in characters, except
+    for `byte_pos`, which takes the byte based col of neovim.
+    """
+
+    def __init__(self,src):
+        self.src = src
+        self._starts = [0]
+        self._starts.extend(m.end() for m in re.finditer('\n',src))
+        # utf-8 offsets of the line starts, built on demand
+        self._byte_starts = None
+
+    @property
+    def lines(self):
+        return len(self._starts)
+
+    def pos(self,lnum,col):
+        return self._starts[lnum-1]+col-1
+
+    def lnum_col(self,pos):
+        if pos<0 or pos>len(self.src):
+            return None
+        idx = bisect.bisect_right(self._starts,pos)-1
+        return (idx+1,pos-self._starts[idx]+1)
+
+    def byte_pos(self,lnum,col):
+        """
+        (lnum, byte col) to utf-8 byte offset
+        """
+        return self._get_byte_starts()[lnum-1]+col-1
+
+    def pos_from_byte(self,byte_pos):
+        """
+        utf-8 byte offset to character offset
+        """
+        byte_starts = self._get_byte_starts()
+        if byte_starts is self._starts:
+            # ascii
+            return byte_pos
+        idx = bisect.bisect_right(byte_starts,byte_pos)-1
+        start = self._starts[idx]
+        line = self.src[start:start+byte_pos-byte_starts[idx]]
+        prefix = line.encode('utf-8')[:byte_pos-byte_starts[idx]]
+        return start+len(prefix.decode('utf-8','ignore'))
+
+    def _get_byte_starts(self):
+        if self._byte_starts is None:
+            if len(self.src.encode('utf-8'))==len(self.src):
+                self._byte_starts = self._starts
+            else:
+                self._byte_starts = [0]
+                for line in self.src.split('\n'):
+                    self._byte_starts.append(self._byte_starts[-1]+len(line.encode('utf-8'))+1)
+                self._byte_starts.pop()
+        return self._byte_starts
+
+# the index of the last few sources, the scopers and the core convert
+# positions of the same snapshot several times
+_line_indexes = deque(maxlen=4)
+# used by the file server threads and the core thread
+_line_indexes_lock = threading.Lock()
+
+def get_line_index(src):
+    with _line_indexes_lock:
+        for index in _line_indexes:
+            if index.src is src:
+                return index
+    index = LineIndex(src)
+    with _line_indexes_lock:
+        _line_indexes.append(index)
+    return index
 
 # convert (lnum, col) to pos
 def get_pos(lnum,col,src):
+    return get_line_index(src).pos(lnum,col)
+
+def get_lnum_col(pos,src):
+    return get_line_index(src).lnum_col(pos)
+
+def change_range(old,new):
+    """
+    Find the edit from old to new, `old[start:old_end]` is replaced by
+    `new[start:new_end]`. Return (start, old_end, new_end), or None if not
+    changed.
+    """
+    if old==new:
+        return None
+    n = min(len(old),len(new))
+
+    # common prefix, each step compares only the untested half, the string
+    # comparisons are done in C
+    lo, hi = 0, n
+    while lo<hi:
+        mid = (lo+hi+1)//2
+        if old[lo:mid]==new[lo:mid]:
+            lo = mid
+        else:
+            hi = mid-1
+    start = lo
+
+    # common suffix, not overlapping the prefix
+    lo, hi = 0, n-start
+    while lo<hi:
+        mid = (lo+hi+1)//2
+        if old[len(old)-mid:len(old)-lo]==new[len(new)-mid:len(new)-lo]:
+            lo = mid
+        else:
+            hi = mid-1
+
+    return (start, len(old)-lo, len(new)-lo)
+
+class Match:
+    """
+    Compact record of a completion candidate. The core builds it once when
+    the matches of a source are received. Filtering, sorting and merging work
+    on these records without copying the item, only the visible ones are
+    turned back into dicts for `complete()`.
+    """
+
+    __slots__ = ('word','item','key','mask','sortkey','score')
+
+    def __init__(self,item):
+        if type(item)==type(''):
+            self.word = item
+            self.item = None
+        else:
+            self.word = item.get('word','')
+            self.item = item
+        # keys precomputed for the matchers and sorters, so that they don't
+        # need to be recomputed on every keystroke
+        self.key = lower_key(self.word)
+        # computed by fuzzy_matcher on demand
+        self.mask = None
+        # in python, 'A' sort's before 'a', we need to swapcase for the 'a'
+        # sorting before 'A'
+        self.sortkey = self.word.swapcase()
+        self.score = 0
+
+    def to_item(self,prefix='',abbr=''):
+        """
+        Build the dict for `complete()`, prefix is joined to the word, and the
+        menu is filled with the abbreviation of the source.
+        """
+        if self.item is None:
+            e = {}
+        else:
+            e = dict(self.item)
+
+        e['word'] = prefix + self.word
+
+        if 'menu' not in e:
+            info = e.get('info','')
+            if info and len(info)<50:
+                if abbr:
+                    e['menu'] = "<%s> %s" % (abbr,info)
+                else:
+                    e['menu'] = info
+            else:
+                # info too long
+                if abbr:
+                    e['menu'] = "<%s>" % abbr
+
+        return e
+
+def lower_key(s):
+    """
+    s.lower(), with one character for each character of s, so that the
+    positions in the key are the positions in s. Some characters lower to
+    more than one, eg. 'İ'.
+    """
+    key = s.lower()
+    if len(key)!=len(s):
+        key = ''.join(c.lower()[:1] for c in s)
+    return key
+
+_char_bits = { chr(i): 1<<i for i in range(128) }
+
+def char_mask(s):
+    """
+    A bitmask of the ascii characters in s. It's only used for rejecting
+    non-matches cheaply, `mask & base_mask == base_mask` is a necessary
+    condition for s to contain all the characters of base.
+    """
+    chars = set(s)
+    try:
+        # each character has its own bit, sum is the same as bitwise or here
+        return sum(map(_char_bits.__getitem__,chars))
+    except KeyError:
+        # non-ascii characters are ignored
+        return sum(map(_char_bits.__getitem__,[c for c in chars if c in _char_bits]))
+
+# Matchers filter a list of `Match` records for the typed base, and sorters
+# sort the survivors. They are selected with `g:cm_matcher` and `g:cm_sorter`.
+#
+# Note that the core narrows the previous result when the user keeps typing,
+# so a matcher must not accept an item for a base if it rejects the item for a
+# prefix of that base.
+
+def prefix_matcher(base,matches):
+    """
+    smart case prefix matching
+    """
+    lbase = lower_key(base)
+    result = [ e for e in matches if e.key.startswith(lbase) ]
+    if lbase!=base:
+        # there're upper case characters in base
+        result = [ e for e in result if smart_case_match(base,e) ]
+    return result
 
-    # curpos
-    lines = src.split('\n')
+def fuzzy_matcher(base,matches):
+    """
+    Subsequence matching, case insensitive. The survivors are scored, higher
+    score for characters matching at the start of the word, at word
+    boundaries, camelCase humps, or contiguous characters.
+    """
+    if not base:
+        for e in matches:
+            e.score = 0
+        return list(matches)
+
+    for e in matches:
+        if e.mask is None:
+            e.mask = char_mask(e.key)
+
+    lbase = lower_key(base)
+    base_mask = char_mask(lbase)
+    candidates = [ e for e in matches if e.mask & base_mask == base_mask ]
+
+    result = []
+    if len(lbase)==1:
+        # fast path for the first character
+        for e in candidates:
+            i = e.key.find(lbase)
+            if i<0:
+                continue
+            if i==0:
+                e.score = 110 + (e.word[0]==base)*5
+            elif e.word[i-1] in _boundary_chars or (e.word[i].isupper() and not e.word[i-1].isupper()):
+                e.score = 6
+            else:
+                e.score = 1
+            result.append(e)
+        return result
+
+    for e in candidates:
+        score = _fuzzy_score(base,lbase,e.word,e.key)
+        if score:
+            e.score = score
+            result.append(e)
+    return result
+
+_boundary_chars = frozenset('_-./:# ')
+
+def _fuzzy_score(base,lbase,word,key):
+
+    if key.startswith(lbase):
+        # prefix matching beats anything else, exact case is better
+        score = 100 + 10*len(lbase)
+        if word.startswith(base):
+            score += 5
+        return score
+
+    score = 0
     pos = 0
-    for i in range(lnum-1):
-        pos += len(lines[i])+1
-    pos += col-1
+    last = -2
+    for c in lbase:
+        i = key.find(c,pos)
+        if i<0:
+            return 0
+        if i==last+1:
+            # contiguous
+            score += 8
+        elif i==0 or word[i-1] in _boundary_chars:
+            score += 6
+        elif word[i].isupper() and not word[i-1].isupper():
+            # camelCase hump
+            score += 6
+        else:
+            score += 1
+        last = i
+        pos = i+1
 
-    return pos
+    # prefer the shorter gaps
+    return max(score - (last+1-len(lbase))//4, 1)
 
-def get_lnum_col(pos,src):
-    splited = src.split("\n")
-    p = 0
-    for idx,line in enumerate(splited):
-        if p<=pos and p+len(line)>=pos:
-            return (idx+1,pos-p+1)
-        p += len(line)+1
+def smart_case_match(base,e):
+    """
+    smart case prefix matching of a `Match` record
+    """
+    if len(base)>len(e.word):
+        return False
+    for a,b in zip(base,e.word):
+        if a.isupper() :
+            if a!=b:
+                return False
+        elif a!=b.lower()[:1]:
+            return False
+    return True
+
+def alnum_match_sorter(base,startcol,matches):
+    """
+    alnum ordering of `Match` records, 'a' before 'A'
+    """
+    matches.sort(key=attrgetter('sortkey'))
+    return matches
+
+# The dict based helpers, for the sources and the scripts using them, the
+# core uses the record based ones above
 
 def smart_case_prefix_matcher(base,item):
     if len(base)>len(item['word']):
@@ -69,3 +699,17 @@ def alnum_sorter(base,startcol,matches):
     matches.sort(key=lambda e: e['word'].swapcase())
     return matches
 
+def score_sorter(base,startcol,matches):
+    """
+    Higher score first, alnum ordering for the same score. Use this with
+    `fuzzy_matcher`.
+    """
+    matches.sort(key=attrgetter('sortkey'))
+    # sort is stable
+    matches.sort(key=attrgetter('score'),reverse=True)
+    return matches
+
+# the core merges the lists of the sources by score for the sorters with this
+# attribute, the lists of other sorters are merged by the source priority only
+score_sorter.merge_by_score = True
+
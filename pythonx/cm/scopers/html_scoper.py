@@ -1,115 +1,180 @@
 # -*- coding: utf-8 -*-
 import re
 import logging
-import urllib
-import http.client
-import copy
+import bisect
+from collections import OrderedDict
 from cm import cm
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
-class Scoper:
-
-    scopes = ['html','xhtml','php','blade','jinja','jinja2']
-
-    def sub_context(self,ctx,src):
-
-        lnum = ctx['lnum']
-        col = ctx['col']
-        from html.parser import HTMLParser
-
-        class MyHTMLParser(HTMLParser):
-
-            last_data_start = None
-            last_data = None
-
-            scope_info = None
-
-            def handle_endtag(self, tag):
-
-                if tag in ['style','script']:
-
-                    startpos = self.last_data_start
-                    endpos = self.getpos()
-                    if ((startpos[0]<lnum 
-                        or (startpos[0]==lnum
-                            and startpos[1]+1<=col))
-                        and
-                        (endpos[0]>lnum
-                         or (endpos[0]==lnum
-                             and endpos[1]>=col))
-                        ):
-
-                        self.scope_info = {}
-                        self.scope_info['lnum'] = lnum-startpos[0]+1
-                        if lnum==startpos[0]:
-                            self.scope_info['col'] = col-(startpos[1]+1)+1
-                        else:
-                            self.scope_info['col']=col
-
-                        if tag=='script':
-                            self.scope_info['scope']='javascript'
-                        else:
-                            # style
-                            self.scope_info['scope']='css'
-
-                        self.scope_info['scope_offset']= cm.get_pos(startpos[0],startpos[1]+1,src)
-                        self.scope_info['scope_len']=len(self.last_data)
-
-                        # offset as lnum, col format
-                        self.scope_info['scope_lnum']= startpos[0]
-                        # startpos[1] is zero based
-                        self.scope_info['scope_col']= startpos[1]+1
-
-
-            def handle_data(self, data):
-                self.last_data = data
-                self.last_data_start = self.getpos()
-
-        parser = MyHTMLParser()
-        parser.feed(src)
-        if parser.scope_info:
-
-            new_ctx = copy.deepcopy(ctx)
-            new_ctx['scope'] = parser.scope_info['scope']
-            new_ctx['lnum'] = parser.scope_info['lnum']
-            new_ctx['col'] = parser.scope_info['col']
-
-            new_ctx['scope_offset'] = parser.scope_info['scope_offset']
-            new_ctx['scope_len'] = parser.scope_info['scope_len']
-            new_ctx['scope_lnum'] = parser.scope_info['scope_lnum']
-            new_ctx['scope_col'] = parser.scope_info['scope_col']
-
-            return new_ctx
-
-
-        pos = cm.get_pos(lnum,col,src)
-        # css completions for style='|'
-        for match in re.finditer(r'style\s*=\s*("|\')(.*?)\1',src):
-            if match.start(2)>pos:
+# an opening <script>/<style> tag, or a style='' attribute
+_token_re = re.compile(r'<(script|style)\b[^>]*>|style\s*=\s*("|\')(.*?)\2', re.I)
+_close_res = dict(script=re.compile(r'</script\s*>', re.I), style=re.compile(r'</style\s*>', re.I))
+
+
+class RegionIndex:
+    """
+    The <script>, <style> bodies and the style='' attributes of a document.
+    After an edit, the document is scanned again from the end of the last
+    construct before any token which may reach the edit, until the scan
+    meets an old construct after the edit, the rest is shifted.
+    """
+
+    def __init__(self):
+        self.src = None
+        # [(start, end, region)], region is None for an empty or unclosed
+        # body
+        self.constructs = []
+        self._starts = []
+        self._ends = []
+
+    def update(self,src):
+        if self.src is None:
+            self.constructs = list(self._scan(src,0))
+        else:
+            change = cm.change_range(self.src,src)
+            if change is None:
                 return
-            if match.end(2)<pos:
-                continue
-            # start < pos and and>=pos
-            new_src = match.group(2)
-
-            new_ctx = copy.deepcopy(ctx)
-            new_ctx['scope'] = 'css'
+            start, old_end, new_end = change
+            delta = new_end-old_end
+
+            # The constructs ending before the edit are not affected, unless
+            # a token before them reaches the edit, eg. an unterminated
+            # `<style` becomes a tag, and swallows the constructs after it,
+            # when a `>` is typed. A tag reaching the edit has no `>` in
+            # between, an attribute reaching the edit starts on the line of
+            # the edit, or right before it.
+            reach = self._attr_reach(self.src.rfind('\n',0,start)+1)
+            lt = self.src.find('<',self.src.rfind('>',0,start)+1,start)
+            if lt>=0:
+                reach = min(reach,lt)
+            i = bisect.bisect_right(self._ends,reach)
+            restart = self._ends[i-1] if i else 0
+            constructs = self.constructs[:i]
+            tail = []
+            for construct in self._scan(src,restart):
+                old_start = construct[0]-delta
+                j = bisect.bisect_left(self._starts,old_start)
+                if old_start>=old_end and j<len(self._starts) and self._starts[j]==old_start:
+                    # synchronized with the old scan
+                    tail = self.constructs[j:]
+                    break
+                constructs.append(construct)
+            for cstart, cend, region in tail:
+                if region:
+                    region = (region[0], region[1]+delta, region[2])
+                constructs.append((cstart+delta, cend+delta, region))
+            self.constructs = constructs
+
+        self.src = src
+        self._starts = [e[0] for e in self.constructs]
+        self._ends = [e[1] for e in self.constructs]
+
+    def _attr_reach(self,pos):
+        # `style`, `=` and the quote of an attribute may be on different
+        # lines, step back over a `style =` right before the line
+        src = self.src
+        j = pos
+        while j and src[j-1].isspace():
+            j -= 1
+        if j and src[j-1]=='=':
+            j -= 1
+            while j and src[j-1].isspace():
+                j -= 1
+        if j>=5 and src[j-5:j].lower()=='style':
+            return j-5
+        return pos
+
+    def _scan(self,src,pos):
+        while True:
+            match = _token_re.search(src,pos)
+            if not match:
+                return
+            if match.group(1):
+                tag = match.group(1).lower()
+                close = _close_res[tag].search(src,match.end())
+                if not close:
+                    # the rest of the document is the unclosed body, it ends
+                    # after the end of the document, so that appending text
+                    # is an edit of this construct
+                    yield (match.start(), len(src)+1, None)
+                    return
+                if tag=='script':
+                    scope = 'javascript'
+                else:
+                    # style
+                    scope = 'css'
+                yield (match.start(), close.end(), (scope, match.end(), close.start()-match.end()))
+                pos = close.end()
+            else:
+                yield (match.start(), match.end(), ('css', match.start(3), len(match.group(3))))
+                pos = match.end()
+
+    def regions(self):
+        return [region for start,end,region in self.constructs if region]
 
-            new_ctx['scope_offset'] = match.start(2)
-            new_ctx['scope_len'] = len(new_src)
-            scope_lnum_col = cm.get_lnum_col(match.start(2),src)
-            new_ctx['scope_lnum'] = scope_lnum_col[0]
-            new_ctx['scope_col'] = scope_lnum_col[1]
 
-            sub_pos = pos - match.start(2)
-            sub_lnum_col = cm.get_lnum_col(sub_pos,new_src)
-            new_ctx['lnum'] = sub_lnum_col[0]
-            new_ctx['col'] = sub_lnum_col[1]
-            return new_ctx
-        
-        return None
+class Scoper:
 
+    scopes = ['html','xhtml','php','blade','jinja','jinja2']
 
+    def __init__(self):
+        # { bufnr: RegionIndex }
+        self._indexes = OrderedDict()
+
+    def regions(self,ctx,src):
+        """
+        <script>, <style> bodies and the style='' attributes, see ScopeCache in
+        cm_core.py
+        """
+        bufnr = ctx['bufnr']
+        index = self._indexes.get(bufnr,None)
+        if index is None:
+            index = RegionIndex()
+            self._indexes[bufnr] = index
+            if len(self._indexes)>8:
+                self._indexes.popitem(last=False)
+        else:
+            self._indexes.move_to_end(bufnr)
+        index.update(src)
+        return index.regions()
+
+    def region_intact(self,region,old_src,new_src,change):
+        start, old_end, new_end = change
+        changed = old_src[start:old_end] + new_src[start:new_end]
+
+        if region is None:
+            # also the characters next to the edit, eg. between = and the quote
+            changed += new_src[start-1:start] + new_src[new_end:new_end+1]
+            # a joined line may close an attribute on the line before
+            if any(c in changed for c in '<>"\'=/\n'):
+                return False
+            if new_src.rfind('<',0,start)>new_src.rfind('>',0,start):
+                # inside a tag, eg. renaming the tag
+                return False
+            # the word around the edit, eg. an attribute renamed to style
+            for src,end in ((old_src,old_end),(new_src,new_end)):
+                word = (re.search(r'[\w-]*$',src[max(start-8,0):start]).group(0)
+                        + src[start:end]
+                        + re.match(r'[\w-]*',src[end:end+8]).group(0))
+                if 'style' in word.lower() or 'script' in word.lower():
+                    return False
+            return True
+
+        scope, offset, length = region
+        quote = old_src[offset-1:offset]
+        if quote in ['"',"'"]:
+            # style attribute, the other quote may close an unterminated
+            # attribute before it, a `>` may close an unterminated tag
+            return not any(c in changed for c in '<>"\'\n')
+
+        # <script> or <style> body, the closing tag, or a style attribute
+        # before the body extended by a quote or a joined line
+        if any(c in changed for c in '<>/\n"\''):
+            return False
+        for src,end in ((old_src,old_end),(new_src,new_end)):
+            if '</' in src[max(start-8,0):end+8]:
+                return False
+        return True
@@ -1,112 +1,118 @@
 # -*- coding: utf-8 -*-
 import re
 import logging
-import urllib
-import http.client
-import copy
+import bisect
+from collections import OrderedDict
 from cm import cm
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# ```lang or ~~~lang, the closing fence is the same marker without language
+_fence_re = re.compile(r'^ *(`{3,}|~{3,}) *(\S*) *$', re.M)
+
+
+class FenceIndex:
+    """
+    The fence lines of a markdown document, sorted by offset. Only the lines
+    touched by an edit are scanned again, instead of the whole document.
+    """
+
+    def __init__(self):
+        self.src = None
+        # [(line_start, line_end, marker, lang)]
+        self.fences = []
+        self._offsets = []
+
+    def update(self,src):
+        if self.src is None:
+            self.fences = self._scan(src,0,len(src))
+        else:
+            change = cm.change_range(self.src,src)
+            if change is None:
+                return
+            start, old_end, new_end = change
+            delta = new_end-old_end
+
+            # the lines touched by the edit, the text before start is the same
+            line_start = src.rfind('\n',0,start)+1
+            old_line_end = self.src.find('\n',old_end)
+            if old_line_end<0:
+                old_line_end = len(self.src)
+            new_line_end = src.find('\n',new_end)
+            if new_line_end<0:
+                new_line_end = len(src)
+
+            lo = bisect.bisect_left(self._offsets,line_start)
+            hi = bisect.bisect_right(self._offsets,old_line_end)
+            tail = [(s+delta,e+delta,marker,lang) for s,e,marker,lang in self.fences[hi:]]
+            self.fences = self.fences[:lo] + self._scan(src,line_start,new_line_end) + tail
+
+        self.src = src
+        self._offsets = [e[0] for e in self.fences]
+
+    def _scan(self,src,begin,end):
+        return [(m.start(),m.end(),m.group(1),m.group(2)) for m in _fence_re.finditer(src,begin,end)]
+
+    def regions(self):
+        """
+        Pair the fences, return the code blocks with a language
+        """
+        regions = []
+        opening = None
+        for line_start, line_end, marker, lang in self.fences:
+            if opening is None:
+                opening = (line_end, marker, lang)
+                continue
+            if marker!=opening[1] or lang:
+                # inside the code block
+                continue
+            # the line break before the closing fence is not part of the
+            # code block
+            offset = opening[0]+1
+            length = line_start-1-offset
+            if opening[2] and length>=0:
+                regions.append((opening[2], offset, length))
+            opening = None
+        return regions
+
 
 class Scoper:
 
     scopes = ['markdown']
 
-    def sub_context(self,ctx,src):
-
-        import mistune
-
-        # hack preprocessing, this affects character counting
-        def preprocessing(text, tab=4):
-            # text = _newline_pattern.sub('\n', text)
-            # text = text.replace('\t', ' ' * tab)
-            # text = text.replace('\u00a0', ' ')
-            # text = text.replace('\u2424', '\n')
-            # pattern = re.compile(r'^ +$', re.M)
-            # return pattern.sub('', text)
-            return text
-
-        mistune.preprocessing = preprocessing
-
-        # hack fences, to make m.end(3) the end of code block
-        # fences = re.compile(
-        #     r'^ *(`{3,}|~{3,}) *(\S+)? *\n'  # ```lang
-        #     r'([\s\S]+?)\s*'
-        #     r'\1 *(?:\n+|$)'  # ```
-        # )
-        mistune.BlockGrammar.fences = re.compile(
-            r'^ *(`{3,}|~{3,}) *(\S+)? *\n'  # ```lang
-            r'([\s\S]+?\s*)'
-            r'\1 *(?:\n+|$)'  # ```
-        )
-
-        # hack the lexer to find this markdown code block on the current cursor
-        class HackBlockLexer(mistune.BlockLexer):
-            def parse(self, text, rules=None):
-                text = text.rstrip('\n')
-                if not rules:
-                    rules = self.default_rules
-                def manipulate(text,pos):
-                    for key in rules:
-                        rule = getattr(self.rules, key)
-                        m = rule.match(text)
-                        if not m:
-                            continue
-                        if (key=='fences' 
-                            and m.group(2)  # language
-                            and pos+m.start(3) <= self.cm_cur_pos 
-                            and pos+m.end(3) > self.cm_cur_pos
-                            ):
-                            self.cm_scope_info = dict(src = text[m.start(3):m.end(3)],
-                                                      pos = self.cm_cur_pos-(pos+m.start(3)),
-                                                      scope_offset = pos+m.start(3),
-                                                      scope = m.group(2),
-                                                           )
-                            logger.info('group: %s', m.group(0))
-                        getattr(self, 'parse_%s' % key)(m)
-                        return m
-                    return False  # pragma: no cover
-                pos = 0
-                while text:
-                    m = manipulate(text,pos)
-                    if m is not False:
-                        pos+=len(m.group(0))
-                        text = text[len(m.group(0)):]
-                        continue
-                    if text:  # pragma: no cover
-                        raise RuntimeError('Infinite loop at: %s' % text)
-                return self.tokens
-
-        block = HackBlockLexer()
-        block.cm_scope_info = None
-
-        pos = cm.get_pos(ctx['lnum'],ctx['col'],src)
-
-        block.cm_cur_pos = pos
-        mistune.markdown(src,block=block)
-
-        if not block.cm_scope_info:
-            return None
-
-        new_pos = block.cm_scope_info['pos']
-        new_src = block.cm_scope_info['src']
-        p = 0
-        for idx,line in enumerate(new_src.split("\n")):
-            if (p<=new_pos) and (p+len(line)+1>new_pos):
-                new_ctx = copy.deepcopy(ctx)
-                new_ctx['scope'] = block.cm_scope_info['scope']
-                new_ctx['lnum'] = idx+1
-                new_ctx['col'] = new_pos-p+1
-                new_ctx['scope_offset'] = block.cm_scope_info['scope_offset']
-                new_ctx['scope_len'] = len(new_src)
-                lnum_col = cm.get_lnum_col(block.cm_scope_info['scope_offset'],src)
-                new_ctx['scope_lnum'] = lnum_col[0]
-                new_ctx['scope_col'] = lnum_col[1]
-                return new_ctx
-            else:
-                p += len(line)+1
-
-        return None
-
+    def __init__(self):
+        # { bufnr: FenceIndex }
+        self._indexes = OrderedDict()
+
+    def regions(self,ctx,src):
+        """
+        The fenced code blocks with a language, see ScopeCache in cm_core.py
+        """
+        bufnr = ctx['bufnr']
+        index = self._indexes.get(bufnr,None)
+        if index is None:
+            index = FenceIndex()
+            self._indexes[bufnr] = index
+            if len(self._indexes)>8:
+                self._indexes.popitem(last=False)
+        else:
+            self._indexes.move_to_end(bufnr)
+        index.update(src)
+        return index.regions()
+
+    def region_intact(self,region,old_src,new_src,change):
+        start, old_end, new_end = change
+        changed = old_src[start:old_end] + new_src[start:new_end]
+        if '\n' in changed or '`' in changed or '~' in changed:
+            return False
+        # editing the fence line, eg. the language, or breaking the fence
+        for src,end in ((old_src,old_end),(new_src,new_end)):
+            line_start = src.rfind('\n',0,start)+1
+            line_end = src.find('\n',end)
+            if line_end<0:
+                line_end = len(src)
+            line = src[line_start:line_end].lstrip(' ')
+            if line.startswith('```') or line.startswith('~~~'):
+                return False
+        return True
@@ -88,6 +88,5 @@ class Source:
         # simply limit the number of matches here, not to explode neovim
         matches = matches[0:1024]
 
-        # cm#complete(src, context, startcol, matches)
-        self._nvim.call('cm#complete', info['name'], ctx, startcol, matches, async=True)
+        cm.complete(self._nvim, info['name'], ctx, startcol, matches)
 
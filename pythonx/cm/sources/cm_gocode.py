@@ -31,8 +31,13 @@ class Source:
     def __init__(self,nvim):
 
         self._nvim = nvim
+        # gocode may take a while, it's killed when a newer context arrives
+        self._worker = cm.RefreshWorker(nvim, self.refresh)
 
     def cm_refresh(self,info,ctx,*args):
+        return self._worker.submit(info,ctx)
+
+    def refresh(self,info,ctx,token):
 
         lnum = ctx['lnum']
         col = ctx['col']
@@ -42,6 +47,7 @@ class Source:
         startcol = col-len(kwtyped)
 
         src = cm.get_src(ctx)
+        token.check()
 
         # completion pattern
         if (re.search(r'[\w_]{2,}$',typed)
@@ -51,21 +57,13 @@ class Source:
         else:
             return
 
-        # compute offset
-        offset = 0
-        for i,line in enumerate(src.split("\n")):
-            if i+1==lnum:
-                offset += col-1
-                break
-            else:
-                # 1 for \n character
-                offset += len(line)+1
-        # offset = self._nvim.eval('line2byte(line("."))-1+col(".")-1')
+        # gocode takes the byte offset, col is byte based too
+        offset = cm.get_line_index(src).byte_pos(lnum,col)
 
         logger.info('src[%s] offset [%s] lnum[%s] col[%s]', src, offset, lnum, col)
 
         proc = subprocess.Popen(args=['gocode','-f','json','autocomplete','%s' % offset], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        result, errs = proc.communicate(src.encode('utf-8'),timeout=30)
+        result, errs = token.communicate(proc,src.encode('utf-8'),timeout=30)
         # result: [1, [{"class": "func", "name": "Print", "type": "func(a ...interface{}) (n int, err error)"}, ...]]
         result = json.loads(result.decode('utf-8')) 
         completions = result[1]
@@ -86,7 +84,6 @@ class Source:
                         )
             matches.append(item)
 
-        # cm#complete(src, context, startcol, matches)
-        ret = self._nvim.call('cm#complete', info['name'], ctx, startcol, matches)
-        logger.info('matches %s, ret %s', matches, ret)
+        cm.complete(self._nvim, info['name'], ctx, startcol, matches, token=token)
+        logger.info('matches %s', matches)
 
@@ -4,14 +4,16 @@
 # NVIM_PYTHON_LOG_FILE=nvim.log NVIM_PYTHON_LOG_LEVEL=INFO nvim
 
 # detach 1 for quick shutdown for neovim, detach 0, 'cause jedi enters infinite
-# loops sometime, don't know why.
+# loops sometime, don't know why. shared 0, jedi is heavy and may hang, keep
+# it out of the shared host.
 from cm import cm
 cm.register_source(name='cm-jedi',
                    priority=9,
                    abbreviation='Py',
                    scopes=['python'],
                    events=['InsertLeave'],
-                   detach=0)
+                   detach=0,
+                   shared=0)
 
 import os
 import re
@@ -26,8 +28,13 @@ class Source:
     def __init__(self,nvim):
 
         self._nvim = nvim
+        # jedi can't be interrupted, the token is checked between the steps
+        self._worker = cm.RefreshWorker(nvim, self.refresh)
 
     def cm_refresh(self,info,ctx,*args):
+        return self._worker.submit(info,ctx)
+
+    def refresh(self,info,ctx,token):
 
         lnum = ctx['lnum']
         col = ctx['col']
@@ -39,6 +46,7 @@ class Source:
 
 
         src = cm.get_src(ctx)
+        token.check()
         if not src.strip():
             # empty src may possibly block jedi execution, don't know why
             logger.info('ignore empty src [%s]', src)
@@ -68,7 +76,7 @@ class Source:
             signature_text = self._get_signature_text(script)
             if signature_text:
                 matches = [dict(word='',empty=1,abbr=signature_text,dup=1),]
-                self._nvim.call('cm#complete', info['name'], ctx, col, matches, True, async=True)
+                cm.complete(self._nvim, info['name'], ctx, col, matches, True, token=token)
             return
 
         if skip_completions:
@@ -76,11 +84,14 @@ class Source:
 
         completions = script.completions()
         logger.info('completions %s', completions)
+        token.check()
 
         matches = []
 
         for complete in completions:
-            
+
+            # docstring is slow
+            token.check()
             item = dict(word=kwtyped+complete.complete,
                         icase=1,
                         dup=1,
@@ -92,9 +103,8 @@ class Source:
                 item['word'] = complete.name
             matches.append(item)
 
-        # cm#complete(src, context, startcol, matches)
-        ret = self._nvim.call('cm#complete', info['name'], ctx, startcol, matches, async=True)
-        logger.info('matches %s, ret %s', matches, ret)
+        cm.complete(self._nvim, info['name'], ctx, startcol, matches, token=token)
+        logger.info('matches %s', matches)
 
     def _get_signature_text(self,script):
         signature_text = ''
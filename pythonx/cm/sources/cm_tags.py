@@ -62,8 +62,7 @@ class Source:
 
         logger.info('matches len %s', len(matches))
 
-        # cm#complete(src, context, startcol, matches)
-        self._nvim.call('cm#complete', info['name'], ctx, startcol, matches, async=True)
+        cm.complete(self._nvim, info['name'], ctx, startcol, matches)
 
 
 def binary_search_lines_by_prefix(prefix,filename):
@@ -92,8 +92,13 @@ class Source:
         path = nvim.eval('split(globpath(&rtp,"node_modules/tern/bin/tern",1),"\\n")[0]')
         self._tern = Tern(path)
         logger.info('eval result: %s', path)
+        # the request to tern is abandoned when a newer context arrives
+        self._worker = cm.RefreshWorker(nvim, self.refresh)
 
     def cm_refresh(self,info,ctx,*args):
+        return self._worker.submit(info,ctx)
+
+    def refresh(self,info,ctx,token):
 
         lnum = ctx['lnum']
         col = ctx['col']
@@ -104,6 +109,7 @@ class Source:
         startcol = col-len(kwtyped)
 
         src = cm.get_src(ctx)
+        token.check()
 
         # completion pattern
         if (re.search(r'[\w_]{2,}$',typed)
@@ -113,7 +119,7 @@ class Source:
         else:
             return
 
-        completions = self._tern.completions(src,lnum-1,len(typed),path)
+        completions = token.call(self._tern.completions,src,lnum-1,len(typed),path)
         logger.info('completions %s, typed[%s], %s', completions,typed,ctx)
 
         if not completions or not completions.get('completions',None):
@@ -131,7 +137,6 @@ class Source:
                         )
             matches.append(item)
 
-        # cm#complete(src, context, startcol, matches)
-        ret = self._nvim.call('cm#complete', info['name'], ctx, startcol, matches)
-        logger.info('matches %s, ret %s', matches, ret)
+        cm.complete(self._nvim, info['name'], ctx, startcol, matches, token=token)
+        logger.info('matches %s', matches)
 
@@ -7,12 +7,24 @@ import os
 import sys
 import re
 import logging
-import copy
 import importlib
 import threading
+import heapq
+import bisect
+import math
+import time
+from itertools import islice
+from collections import deque, OrderedDict
 from threading import Thread, RLock
 import urllib
 import json
+import tempfile
+import shutil
+import socketserver
+import socket
+import select
+import signal
+import subprocess
 from neovim import attach, setup_logging
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from cm import cm
@@ -33,29 +45,42 @@ class CoreHandler:
         # { '{source_name}': {'startcol': , 'matches'}
         self._matches = {}
         self._sources = {}
+        # mirrors s:sources_version in autoload/cm.vim
+        self._sources_version = -1
         self._last_matches = []
         # should be True for supporting display menu directly without cm_refresh
         self._has_popped_up = True
         self._subscope_detectors = {}
 
+        # registration metadata of the modules, for registering the scopers
+        # and the sources without importing them
+        manifest = Manifest(os.path.join(os.environ.get('XDG_CACHE_HOME',os.path.expanduser('~/.cache')),
+                                         'nvim-completion-manager','manifest.json'))
+        registering_start = time.time()
+
         scoper_paths = self._nvim.eval("globpath(&rtp,'pythonx/cm/scopers/*.py')").split("\n")
 
-        # auto find scopers
+        # auto find scopers, they are imported on the first use of the scope,
+        # see _get_scopers
+        self._scopers = {}
         for path in scoper_paths:
             if not path:
                 continue
             try:
                 modulename = os.path.splitext(os.path.basename(path))[0]
                 modulename = "cm.scopers.%s" % modulename
-                m = importlib.import_module(modulename)
 
-                scoper = m.Scoper()
-                for scope in scoper.scopes:
+                data = manifest.get(path)
+                if data is None:
+                    scoper = self._import_scoper(modulename)
+                    data = dict(scopes=list(scoper.scopes))
+                    manifest.set(path,data)
+
+                for scope in data['scopes']:
                     if scope not in self._subscope_detectors:
                         self._subscope_detectors[scope] = []
-                    self._subscope_detectors[scope].append(scoper)
-                    logger.info('scoper <%s> imported for %s', modulename, scope)
-
+                    self._subscope_detectors[scope].append(modulename)
+                    logger.info('scoper <%s> registered for %s', modulename, scope)
 
             except Exception as ex:
                 logger.exception('importing scoper <%s> failed: %s', modulename, ex)
@@ -63,94 +88,258 @@ class CoreHandler:
         # auto find sources
         sources_paths = self._nvim.eval("globpath(&rtp,'pythonx/cm/sources/*.py')").split("\n")
         for path in sources_paths:
+            if not path:
+                continue
 
             modulename = os.path.splitext(os.path.basename(path))[0]
             modulename = "cm.sources.%s" % modulename
 
-            # use a trick to only register the source withou loading the entire
-            # module
-            def register_source(name,abbreviation,priority,scopes=None,cm_refresh_patterns=None,events=[],detach=0):
-
-                # " jedi
-                # " refresh 1 for call signatures
-                # " detach 0, jedi enters infinite loops sometime, don't know why.
-                # call cm#register_source({
-                # 		\ 'name' : 'cm-jedi',
-                # 		\ 'priority': 9, 
-                # 		\ 'abbreviation': 'Py',
-                # 		\ 'scopes': ['python'],
-                # 		\ 'refresh': 1, 
-                # 		\ 'channels': [
-                # 		\   {
-                # 		\		'type': 'python3',
-                # 		\		'path': 'autoload/cm/sources/cm_jedi.py',
-                # 		\		'events': ['InsertLeave'],
-                # 		\		'detach': 0,
-                # 		\   }
-                # 		\ ],
-                # 		\ })
-
-                channel = dict(type='python3',
-                               path= modulename,
-                               detach=detach,
-                               events=events)
-
-                source = {}
-                source['channels']            = [channel]
-                source['name']                = name
-                source['priority']            = priority
-                source['abbreviation']        = abbreviation
-                if cm_refresh_patterns:
-                    source['cm_refresh_patterns'] = cm_refresh_patterns
-                if scopes:
-                    source['scopes'] = scopes
-
-                logger.info('registering source: %s',source)
-                nvim.call('cm#register_source',source)
+            data = manifest.get(path)
+            if data is None:
+
+                registrations = []
 
                 # use a trick to only register the source withou loading the entire
                 # module
-                raise CmSkipLoading()
+                def register_source(name,abbreviation,priority,scopes=None,cm_refresh_patterns=None,events=[],detach=0,shared=1):
+                    registrations.append(dict(name=name,
+                                              abbreviation=abbreviation,
+                                              priority=priority,
+                                              scopes=scopes,
+                                              cm_refresh_patterns=cm_refresh_patterns,
+                                              events=events,
+                                              detach=detach,
+                                              shared=shared))
+                    raise CmSkipLoading()
+
+                cm.register_source = register_source
+                try:
+                    # register_source
+                    m = importlib.import_module(modulename)
+                except CmSkipLoading:
+                    # This is not an error
+                    pass
+                except Exception as ex:
+                    logger.exception("register_source for %s failed", modulename)
+                    continue
+                data = dict(sources=registrations)
+                manifest.set(path,data)
 
-            cm.register_source = register_source
-            try:
-                # register_source
-                m = importlib.import_module(modulename)
-            except CmSkipLoading:
-                # This is not an error
+            for registration in data['sources']:
+                self._register_source(modulename,**registration)
                 logger.info('source <%s> registered', modulename)
-            except Exception as ex:
-                logger.exception("register_source for %s failed", modulename)
 
+        manifest.save(scoper_paths+sources_paths)
+        logger.info('registering scopers and sources takes %.1fms', (time.time()-registering_start)*1000)
 
         logger.info('_subscope_detectors: %s', self._subscope_detectors)
 
-        self._file_server = FileServer()
+        self._file_server = FileServer(self._nvim.eval('g:cm_buffer_cache_size'))
         self._file_server.start(self._nvim.eval('v:servername'))
 
-        self._matcher = cm.smart_case_prefix_matcher
-        self._sorter = cm.alnum_sorter
+        # for sources pushing matches to the core directly
+        self._complete_server = CompleteServer()
+        try:
+            self._complete_server.start(self._on_complete_server_message)
+        except Exception as ex:
+            logger.exception('starting CompleteServer failed, sources will use cm#complete: %s', ex)
+            self._complete_server = None
+
+        # fork server for fast channel startup
+        self._zygote = None
+        if self._nvim.eval('g:cm_zygote'):
+            self._zygote = Zygote()
+            self._zygote.start(self._nvim.eval('v:servername'),self._on_zygote_message)
+
+        self._matcher = self._load_function(self._nvim.eval('g:cm_matcher'), cm.prefix_matcher)
+        self._sorter = self._load_function(self._nvim.eval('g:cm_sorter'), cm.alnum_match_sorter)
+        # the sources are merged by score only if the sorter sorts by score,
+        # otherwise the score order is not the order of the lists
+        self._merge_by_score = getattr(self._sorter,'merge_by_score',False)
+        # limit the number of items for the popup menu
+        self._matches_max = self._nvim.eval('g:cm_matches_max')
+
+        # for deciding how long the popup waits for the sources
+        self._complete_delay = self._nvim.eval('g:cm_complete_delay')
+        self._latency = LatencyTracker()
+        self._waiting = set()
+
+        # per stage latency histograms, for :CmStats
+        self._stats = Stats()
+
+        # regions of the scopers, reused between keystrokes
+        self._scope_cache = ScopeCache(self._stats)
+
+        # kills and restarts the channel sources not responding in time
+        self._watchdog = Watchdog(self._stats, self._nvim.eval('g:cm_refresh_deadline')/1000)
 
         self._ctx = None
 
-    def cm_complete(self,srcs,name,ctx,startcol,matches,refresh=0,*args):
+    def _register_source(self,modulename,name,abbreviation,priority,scopes=None,cm_refresh_patterns=None,events=[],detach=0,shared=1):
+
+        # " jedi
+        # " refresh 1 for call signatures
+        # " detach 0, jedi enters infinite loops sometime, don't know why.
+        # call cm#register_source({
+        # 		\ 'name' : 'cm-jedi',
+        # 		\ 'priority': 9, 
+        # 		\ 'abbreviation': 'Py',
+        # 		\ 'scopes': ['python'],
+        # 		\ 'refresh': 1, 
+        # 		\ 'channels': [
+        # 		\   {
+        # 		\		'type': 'python3',
+        # 		\		'path': 'autoload/cm/sources/cm_jedi.py',
+        # 		\		'events': ['InsertLeave'],
+        # 		\		'detach': 0,
+        # 		\   }
+        # 		\ ],
+        # 		\ })
+
+        channel = dict(type='python3',
+                       path= modulename,
+                       detach=detach,
+                       events=events,
+                       shared=shared)
+
+        source = {}
+        source['channels']            = [channel]
+        source['name']                = name
+        source['priority']            = priority
+        source['abbreviation']        = abbreviation
+        if cm_refresh_patterns:
+            source['cm_refresh_patterns'] = cm_refresh_patterns
+        if scopes:
+            source['scopes'] = scopes
+
+        logger.info('registering source: %s',source)
+        self._nvim.call('cm#register_source',source)
+
+    def _import_scoper(self,modulename):
+        if modulename not in self._scopers:
+            m = importlib.import_module(modulename)
+            self._scopers[modulename] = m.Scoper()
+            logger.info('scoper <%s> imported', modulename)
+        return self._scopers[modulename]
+
+    def _get_scopers(self,scope):
+        """
+        The scopers of the scope, imported on the first use
+        """
+        scopers = []
+        for modulename in self._subscope_detectors.get(scope,[]):
+            try:
+                scopers.append(self._import_scoper(modulename))
+            except Exception as ex:
+                logger.exception('importing scoper <%s> failed: %s', modulename, ex)
+                self._subscope_detectors[scope].remove(modulename)
+        return scopers
+
+    def _load_function(self,opt,default):
+        """
+        load matcher or sorter from option {'module': , 'name': }
+        """
+        try:
+            m = importlib.import_module(opt['module'])
+            return getattr(m,opt['name'])
+        except Exception as ex:
+            logger.exception('loading %s failed, use default %s: %s', opt, default, ex)
+            return default
+
+    def cm_sources_changed(self,version,changed,removed,*args):
+        if version<=self._sources_version:
+            # already included in a full sync
+            return
+        if version!=self._sources_version+1:
+            # some deltas are missed, eg. sources registered before the core
+            # channel started
+            self._sync_sources(version)
+            return
+        self._sources.update(changed)
+        for name in removed:
+            self._sources.pop(name,None)
+            self._matches.pop(name,None)
+        self._sources_version = version
+
+    def _sync_sources(self,version):
+        if version==self._sources_version:
+            return
+        logger.info('sources version [%s], expecting [%s], full sync', self._sources_version, version)
+        self._sources_version, self._sources = self._nvim.call('cm#_sources')
+
+    def _on_complete_server_message(self,method,args):
+        """
+        This method is running on the thread of the CompleteServer connection
+        """
+        if method=='cm_refresh_done':
+            self._nvim.async_call(self.cm_refresh_done,*args)
+            return
+        if method!='cm_complete':
+            logger.info('CompleteServer method: %s not implemented, ignore this message', method)
+            return
+        self._nvim.async_call(self._complete_direct,*args)
+
+    def _on_zygote_message(self,msg):
+        """
+        This method is running on the thread of the Zygote connection
+        """
+        if 'exited' in msg:
+            self._nvim.async_call(lambda: self._nvim.call('cm#_channel_exited',msg['exited'],async=True))
+        elif 'failed' in msg:
+            self._nvim.async_call(lambda: self._nvim.call('cm#_channel_start_failed',msg['failed'],async=True))
+
+    def cm_zygote_start(self,name,modulename):
+        if self._zygote is None:
+            self._nvim.call('cm#_channel_start_failed',name,async=True)
+            return
+        self._zygote.fork(name,modulename)
+
+    def _complete_direct(self,name,ctx,startcol,matches,refresh=0,*args):
+        # the checks of cm#complete, for the matches pushed by the sources
+        # directly, the outdated context is checked by cm_complete
+        if name not in self._sources:
+            logger.info('ignore cm_complete from unregistered source [%s]', name)
+            return
+        self.cm_complete(self._sources_version,name,ctx,startcol,matches,refresh)
+
+    def cm_complete(self,version,name,ctx,startcol,matches,refresh=0,*args):
 
         # adjust for subscope
         if ctx['lnum']==1:
             startcol += ctx.get('scope_col',1)-1
 
-        # if cm.context_outdated(self._ctx,ctx):
-        #     logger.info('ignore outdated context from [%s]', name)
-        #     return
+        self._sync_sources(version)
+        self._watchdog.done(name,ctx)
+
+        latency = self._latency.replied(name,ctx)
+        if latency is not None:
+            self._stats.record('latency',latency,name)
+        if 'refresh_start' in ctx:
+            # stamped by the channel when it starts computing
+            self._stats.record('compute',time.time()-ctx['refresh_start'],name)
+
+        # self._ctx is kept up to date by cm_refresh and cm_context, no need
+        # to ask neovim for the current context
+        if cm.context_outdated(self._ctx,ctx):
+            logger.info('ignore outdated context from [%s]', name)
+            return
+
+        # popup now if this is the last source the popup is waiting for
+        replied_all = False
+        if (not self._has_popped_up) and (name in self._waiting):
+            self._waiting.discard(name)
+            replied_all = not self._waiting
 
-        self._sources = srcs
+        # build the compact records once, they are shared by all the
+        # following refreshes until the source sends new matches
+        matches = [cm.Match(item) for item in matches]
 
         try:
 
             # process the matches early to eliminate unnecessary complete function call
             result = self.process_matches(name,ctx,startcol,matches)
 
-            if (not result) and (not self._matches.get(name,{}).get('last_matches',[])):
+            if (not result) and (not self._matches.get(name,{}).get('last_matches',[])) and (not replied_all):
                 # not popping up, ignore this request
                 logger.info('Not popping up, not refreshing for cm_complete by %s, startcol %s', name, startcol)
                 return
@@ -168,35 +357,97 @@ class CoreHandler:
                 self._matches[name]['startcol'] = startcol
                 self._matches[name]['refresh'] = refresh
                 self._matches[name]['matches'] = matches
+                # new matches, the narrowing result is no longer valid
+                self._matches[name].pop('narrowed',None)
 
         # wait for cm_complete_timeout, reduce flashes
         if self._has_popped_up:
             logger.info("update popup for [%s]",name)
             # the ctx in parameter maybe a subctx for completion source, use
-            # nvim.call to get the root context
-            self._refresh_completions(self._nvim.call('cm#context'))
+            # the root context
+            self._refresh_completions(self._root_context())
+        elif replied_all:
+            logger.info("all waited sources replied, popup now for [%s]",name)
+            self._refresh_completions(self._root_context())
+            self._has_popped_up = True
         else:
             logger.info("delay popup for [%s]",name)
 
     def cm_insert_enter(self):
         self._matches = {}
 
-    def cm_complete_timeout(self,srcs,ctx,*args):
+    def cm_insert_leave(self):
+        # the replies arriving after leaving insert mode are outdated
+        self._ctx = None
+        self._waiting = set()
+
+    def cm_context(self,tick,*args):
+        """
+        The buffer changed or the cursor moved without a cm_refresh, eg. in
+        paste mode. changedtick and curpos is enough for outdating check.
+        """
+        changedtick, curpos = tick
+        self._ctx = dict(changedtick=changedtick,curpos=curpos)
+
+    def _root_context(self):
+        """
+        The root context for the popup, cm_context only keeps the tick of it,
+        ask neovim for the full one then
+        """
+        if 'typed' not in self._ctx:
+            ctx = self._nvim.call('cm#context')
+            ctx['scope'] = ctx['filetype']
+            self._ctx = ctx
+        return self._ctx
+
+    def cm_refresh_done(self,name,ctx,dropped=0,*args):
+        """
+        A channel source has finished or dropped a refresh, ctx has the
+        changedtick and curpos of the refresh
+        """
+        self._watchdog.done(name,ctx,not dropped)
+
+    def _check_watchdog(self):
+        for name in self._watchdog.expired():
+            info = self._sources.get(name,{})
+            channels = [c for c in info.get('channels',[]) if 'id' in c and c.get('pid',None)]
+            if not channels:
+                logger.error('source [%s] is not responding, and could not be killed', name)
+                continue
+            for channel in channels:
+                logger.error('source [%s] is not responding, killing pid %s', name, channel['pid'])
+                try:
+                    os.kill(channel['pid'],signal.SIGKILL)
+                except Exception as ex:
+                    logger.exception('killing pid %s failed: %s', channel['pid'], ex)
+                host = channel.get('host',None)
+                if host is None or host=='zygote':
+                    continue
+                # the pid is the shared host, the other sources in it are
+                # stopped too
+                for other,other_info in self._sources.items():
+                    if other!=name and any(c.get('host',None)==host for c in other_info.get('channels',[])):
+                        self._watchdog.stopped(other)
+            self._watchdog.killed(name)
+
+    def cm_complete_timeout(self,version,ctx,*args):
         if not self._has_popped_up:
             self._refresh_completions(ctx)
             self._has_popped_up = True
 
     # The completion core itself
-    def cm_refresh(self,srcs,root_ctx,*args):
+    def cm_refresh(self,version,root_ctx,*args):
 
         # update file server
         self._ctx = root_ctx
         self._file_server.set_current_ctx(root_ctx)
 
+        self._check_watchdog()
+
         # initial scope
         root_ctx['scope'] = root_ctx['filetype']
 
-        self._sources = srcs
+        self._sync_sources(version)
         self._has_popped_up = False
 
         # simple complete done
@@ -206,17 +457,29 @@ class CoreHandler:
             self._matches = {}
 
         root_ctx['src_uri'] = self._file_server.get_src_uri(root_ctx)
+        if self._file_server.address:
+            root_ctx['src_addr'] = self._file_server.address
+        if self._complete_server:
+            # sub contexts are copied from the root context
+            root_ctx['complete_addr'] = self._complete_server.address
         ctx_lists = [root_ctx,]
 
         # scoping
+        scoping_start = time.time()
         i = 0
         while i<len(ctx_lists):
             ctx = ctx_lists[i]
             scope = ctx['scope']
             if scope in self._subscope_detectors:
-                for detector in self._subscope_detectors[scope]:
+                src = self._file_server.get_src(ctx)
+                for detector in self._get_scopers(scope):
+                    if src is None:
+                        break
                     try:
-                        sub_ctx = detector.sub_context(ctx, self._file_server.get_src(ctx))
+                        if hasattr(detector,'regions'):
+                            sub_ctx = self._scope_cache.sub_context(detector, ctx, src)
+                        else:
+                            sub_ctx = detector.sub_context(ctx, src)
                         if sub_ctx:
                             # adjust offset to global based
                             # and add the new context
@@ -234,15 +497,19 @@ class CoreHandler:
 
             i += 1
 
+        self._stats.record('scoping',time.time()-scoping_start)
+
         # do notify_sources_to_refresh
         refreshes_calls = []
-        refreshes_channels = []
+        # {(channel_id,name): dict(name=,id=,contexts=[])}, the contexts for
+        # the same channel are batched into one notification
+        refreshes_channels = OrderedDict()
 
         # get the sources that need to be notified
         for ctx in ctx_lists:
-            for name in srcs:
+            for name in list(self._sources.keys()):
 
-                info = srcs[name]
+                info = self._sources[name]
                 if not info.get('enable',True):
                     # ignore disabled source
                     continue
@@ -268,27 +535,69 @@ class CoreHandler:
                     # start channels on demand here
                     if info.get('channels',None):
                         channel = info['channels'][0]
-                        if 'id' not in channel:
-                            if channel.get('has_terminated',0)==0:
+                        if 'id' not in channel and 'host' not in channel:
+                            if channel.get('has_terminated',0)==0 or self._watchdog.may_restart(name):
                                 logger.info('starting channels for %s',name)
                                 # has not been started yet, start it now
                                 info = self._nvim.call('cm#_start_channels',name)
+                                self._sources[name] = info
 
                     for channel in info.get('channels',[]):
                         if 'id' in channel:
-                            refreshes_channels.append(dict(name=name,id=channel['id'],context=ctx))
+                            key = (channel['id'],name)
+                            if key not in refreshes_channels:
+                                refreshes_channels[key] = dict(name=name,id=channel['id'],contexts=[])
+                                self._watchdog.dispatched(name,ctx)
+                            refreshes_channels[key]['contexts'].append(ctx)
                 except Exception as inst:
                     logger.exception('cm_refresh process exception: %s', inst)
                     continue
 
+        refreshes_channels = list(refreshes_channels.values())
+
         if not refreshes_calls and not refreshes_channels:
             logger.info('not notifying any channels, _refresh_completions now')
             self._refresh_completions(root_ctx)
             self._has_popped_up = True
         else:
-            logger.info('notify_sources_to_refresh calls cnt [%s], channels cnt [%s]',len(refreshes_calls),len(refreshes_channels))
+            names = set([e['name'] for e in refreshes_calls + refreshes_channels])
+            for name in names:
+                self._latency.dispatched(name,root_ctx)
+            self._waiting, delay = self._popup_wait(names)
+            if not self._waiting:
+                logger.info('all sources are slow, _refresh_completions now')
+                self._refresh_completions(root_ctx)
+                self._has_popped_up = True
+
+            logger.info('notify_sources_to_refresh calls cnt [%s], channels cnt [%s], waiting %s for %sms',len(refreshes_calls),len(refreshes_channels),self._waiting,delay)
             logger.debug('cm#_notify_sources_to_refresh [%s] [%s] [%s]', refreshes_calls, refreshes_channels, root_ctx)
-            self._nvim.call('cm#_notify_sources_to_refresh', refreshes_calls, refreshes_channels, root_ctx)
+            dispatch_start = time.time()
+            self._nvim.call('cm#_notify_sources_to_refresh', refreshes_calls, refreshes_channels, root_ctx, delay)
+            self._stats.record('dispatch',time.time()-dispatch_start)
+
+    def _popup_wait(self,names):
+        """
+        Decide which of the refreshing sources the popup waits for, and the
+        max time to wait, in milliseconds, by the latency history of the
+        sources. A source usually replying within g:cm_complete_delay is
+        waited for its p95 latency. A source known to be slow (p50 exceeds
+        g:cm_complete_delay) is not waited, the popup will be updated when it
+        replies.
+        """
+        waiting = set()
+        delay = 0
+        for name in names:
+            p50 = self._latency.percentile(name,50)
+            if p50 is None:
+                # no history yet
+                wait = self._complete_delay
+            elif p50*1000 > self._complete_delay:
+                continue
+            else:
+                wait = min(self._latency.percentile(name,95)*1000, self._complete_delay)
+            waiting.add(name)
+            delay = max(delay,wait)
+        return waiting, int(math.ceil(delay))
 
     # check patterns for dict, if non dict, return True
     def _check_refresh_patterns(self,typed,opt):
@@ -316,8 +625,6 @@ class CoreHandler:
 
     def _refresh_completions(self,ctx):
 
-        matches = []
-
         # sort by priority
         names = sorted(self._matches.keys(),key=lambda x: self._sources[x]['priority'], reverse=True)
 
@@ -344,8 +651,9 @@ class CoreHandler:
                     logger.error('ignoring invalid startcol for %s %s', name, self._matches[name]['startcol'])
                     continue
 
-                source_matches = self._matches[name]['matches']
-                source_matches = self.process_matches(name,ctx,source_startcol,source_matches)
+                process_start = time.time()
+                source_matches = self._narrow_matches(name,ctx,source_startcol)
+                self._stats.record('process',time.time()-process_start,name)
 
                 self._matches[name]['last_matches'] = source_matches
 
@@ -361,6 +669,8 @@ class CoreHandler:
                 continue
 
         # merge processing results of sources
+        merge_start = time.time()
+        sorted_lists = []
         for name in names:
 
             try:
@@ -371,59 +681,73 @@ class CoreHandler:
 
                 prefix = ctx['typed'][startcol-1 : source_startcol-1]
 
-                for e in source_matches:
-                    e['word'] = prefix + e['word']
-                    # if 'abbr' in e:
-                    #     e['abbr'] = prefix + e['abbr']
+                abbr = self._sources[name].get('abbreviation','')
+                priority = self._sources[name]['priority']
 
-                matches += source_matches
+                sorted_lists.append(self._merge_keys(len(sorted_lists),source_matches,priority,prefix,abbr))
 
             except Exception as inst:
                 logger.exception('_refresh_completions process exception: %s', inst)
                 continue
 
+        # k-way merge of the sorted lists, by score if the sorter is score
+        # based, and then by the priority of the sources, keeping the order of
+        # the sorter. Only the first self._matches_max items are taken,
+        # and only these visible records are turned into dicts for complete()
+        merged = heapq.merge(*sorted_lists)
+        if self._matches_max>0:
+            merged = islice(merged,self._matches_max)
+        matches = [ e.to_item(prefix,abbr) for _,_,_,_,e,prefix,abbr in merged ]
+        self._stats.record('merge',time.time()-merge_start)
+
         if not matches:
             startcol=len(ctx['typed']) or 1
         logger.info('_refresh_completions names: %s, startcol: %s, matches cnt: %s', names, startcol, len(matches))
         logger.debug('_refresh_completions names: %s, startcol: %s, matches: %s, source matches: %s', names, startcol, matches, self._matches)
         self._complete(ctx, startcol, matches)
 
+    def _merge_keys(self,idx,source_matches,priority,prefix,abbr):
+        # idx and rank make the keys unique, the records are never compared
+        sign = -1 if self._merge_by_score else 0
+        for rank,e in enumerate(source_matches):
+            yield (sign*e.score,-priority,idx,rank,e,prefix,abbr)
+
+    def _narrow_matches(self,name,ctx,startcol):
+        """
+        Filter and sort the stored matches of the source. The result is
+        remembered with its (startcol, base). When the user keeps typing, the
+        new base extends the old one, and only the previous survivors need to
+        be scanned, since an item rejected by the matcher for a base will also
+        be rejected for any longer base.
+        """
+
+        source = self._matches[name]
+        base = ctx['typed'][startcol-1:]
+
+        narrowed = source.get('narrowed',None)
+        if narrowed and narrowed['startcol']==startcol and base.startswith(narrowed['base']):
+            if narrowed['base']==base:
+                return narrowed['result']
+            result = self._matcher(base,narrowed['result'])
+            result = self._sorter(base,startcol,result)
+            logger.debug('narrowed [%s] from [%s] to [%s], cnt %s -> %s', name, narrowed['base'], base, len(narrowed['result']), len(result))
+        else:
+            result = self.process_matches(name,ctx,startcol,source['matches'])
+
+        source['narrowed'] = dict(startcol=startcol,base=base,result=result)
+        return result
+
     def process_matches(self,name,ctx,startcol,matches):
+        """
+        @type matches: list of cm.Match
+        """
 
         base = ctx['typed'][startcol-1:]
-        abbr = self._sources[name].get('abbreviation','')
-
-        # formalize datastructure
-        formalized = []
-        for item in matches:
-            e = {}
-            if type(item)==type(''):
-                e['word'] = item
-            else:
-                e = copy.deepcopy(item)
-            formalized.append(e)
 
         # filtering and sorting
-        result = [ e for e in formalized if self._matcher(base=base,item=e)]
+        result = self._matcher(base,matches)
         result = self._sorter(base,startcol,result)
 
-        # fix some text
-        for e in result:
-
-            if 'menu' not in e:
-                if 'info' in e and e['info'] and len(e['info'])<50:
-                    if abbr:
-                        e['menu'] = "<%s> %s" % (abbr,e['info'])
-                    else:
-                        e['menu'] = e['info']
-                else:
-                    # info too long
-                    if abbr:
-                        e['menu'] = "<%s>" % abbr
-            else:
-                # e['menu'] = "<%s> %s"  % (self._sources[name]['abbreviation'], e['info'])
-                pass
-
         return result
 
 
@@ -432,11 +756,782 @@ class CoreHandler:
             # no need to fire complete message
             logger.info('matches==0, _last_matches==0, ignore')
             return
+        complete_start = time.time()
         self._nvim.call('cm#_core_complete', ctx, startcol, matches, async=True)
+        self._stats.record('core_complete',time.time()-complete_start)
         self._last_matches = matches
 
+    def cm_stats(self,*args):
+        """
+        rpc request for :CmStats
+        """
+        return self._stats.report()
+
     def cm_shutdown(self):
         self._file_server.shutdown(wait=False)
+        if self._complete_server:
+            self._complete_server.shutdown(wait=False)
+        if self._zygote:
+            self._zygote.shutdown()
+
+
+class Manifest:
+    """
+    On-disk cache of the registration metadata of the scopers and the
+    sources, keyed by the module path and mtime, so that the modules are only
+    imported at startup after they are changed.
+    """
+
+    # bump it when the format of the data changes
+    version = 1
+
+    def __init__(self,path):
+        self._path = path
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(path,'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version',None)==self.version:
+                self._entries = manifest['entries']
+        except Exception as ex:
+            logger.info('manifest %s not loaded: %s', path, ex)
+
+    def get(self,path):
+        """
+        The data of the module, None if it's not cached or outdated
+        """
+        entry = self._entries.get(path,None)
+        try:
+            if entry and entry['mtime']==os.stat(path).st_mtime:
+                return entry['data']
+        except OSError:
+            pass
+        return None
+
+    def set(self,path,data):
+        try:
+            self._entries[path] = dict(mtime=os.stat(path).st_mtime,data=data)
+            self._dirty = True
+        except OSError:
+            pass
+
+    def save(self,paths):
+        """
+        Save the manifest, the modules not in paths are removed
+        """
+        paths = set(paths)
+        for path in list(self._entries.keys()):
+            if path not in paths:
+                del self._entries[path]
+                self._dirty = True
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path),exist_ok=True)
+            tmp = '%s.%s' % (self._path,os.getpid())
+            with open(tmp,'w') as f:
+                json.dump(dict(version=self.version,entries=self._entries),f)
+            os.replace(tmp,self._path)
+            self._dirty = False
+        except Exception as ex:
+            logger.exception('saving manifest %s failed: %s', self._path, ex)
+
+
+class Watchdog:
+    """
+    Deadline of the refreshes of the channel sources. A source acknowledges
+    the refreshes with cm_refresh_done or the matches, a source not
+    responding in time, eg. jedi in an infinite loop, is killed, and
+    restarted on demand after a backoff, which doubles with each consecutive
+    kill.
+    """
+
+    def __init__(self,stats,deadline,backoff=1,backoff_max=64):
+        self._stats = stats
+        # in seconds, 0 for disabled
+        self._deadline = deadline
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        # { name: OrderedDict{ (changedtick,curpos): dispatch time } }, the
+        # refreshes not acknowledged, oldest first
+        self._outstanding = {}
+        # { name: consecutive kills }
+        self._kills = {}
+        # { name: time after which the killed source may be restarted }
+        self._restart_at = {}
+
+    def dispatched(self,name,ctx):
+        if self._deadline<=0:
+            return
+        pending = self._outstanding.setdefault(name,OrderedDict())
+        key = self._key(ctx)
+        if key not in pending:
+            pending[key] = time.time()
+
+    def done(self,name,ctx,progress=True):
+        """
+        Acknowledge the refresh of ctx only, the refreshes dropped by a
+        source are acknowledged while the running one may still be stuck.
+        progress is False for the dropped ones, the backoff is only reset
+        when the source really finishes a refresh.
+        """
+        pending = self._outstanding.get(name,None)
+        if pending is not None:
+            pending.pop(self._key(ctx),None)
+            if not pending:
+                del self._outstanding[name]
+        if progress:
+            self._kills.pop(name,None)
+
+    def _key(self,ctx):
+        # the contexts of a refresh share the changedtick and curpos
+        return (ctx['changedtick'],tuple(ctx['curpos']))
+
+    def expired(self):
+        """
+        The sources past the deadline
+        """
+        now = time.time()
+        names = [name for name,pending in self._outstanding.items()
+                 if now-next(iter(pending.values()))>self._deadline]
+        for name in names:
+            del self._outstanding[name]
+            self._stats.count('watchdog_expired',name)
+        return names
+
+    def killed(self,name):
+        kills = self._kills.get(name,0)+1
+        self._kills[name] = kills
+        backoff = min(self._backoff*2**(kills-1),self._backoff_max)
+        self._restart_at[name] = time.time()+backoff
+        self._stats.count('watchdog_kill',name)
+        logger.info('source [%s] killed %s times, restart after %ss', name, kills, backoff)
+
+    def stopped(self,name):
+        """
+        The source is stopped with a killed one, eg. in the same shared host,
+        it may be restarted right away
+        """
+        self._outstanding.pop(name,None)
+        self._restart_at[name] = time.time()
+
+    def may_restart(self,name):
+        restart_at = self._restart_at.get(name,None)
+        if restart_at is None or time.time()<restart_at:
+            return False
+        del self._restart_at[name]
+        self._stats.count('watchdog_restart',name)
+        return True
+
+
+class LatencyTracker:
+    """
+    Rolling window of the latency from refresh to cm_complete, for each source
+    """
+
+    def __init__(self,window=32,min_samples=3):
+        self._window = window
+        self._min_samples = min_samples
+        # { name: deque of seconds }
+        self._samples = {}
+        # { name: OrderedDict{ (changedtick,curpos): dispatch time } }
+        self._dispatched = {}
+
+    def _key(self,ctx):
+        return (ctx['changedtick'],tuple(ctx['curpos']))
+
+    def dispatched(self,name,ctx):
+        if name not in self._dispatched:
+            self._dispatched[name] = OrderedDict()
+        dispatched = self._dispatched[name]
+        dispatched[self._key(ctx)] = time.time()
+        # the source may not reply at all, drop the old ones
+        while len(dispatched)>self._window:
+            dispatched.popitem(last=False)
+
+    def replied(self,name,ctx):
+        """
+        Record the latency of a reply, return the latency in seconds, or None
+        if the refresh of this reply was not dispatched by the core.
+        """
+        dispatched = self._dispatched.get(name,None)
+        if not dispatched:
+            return None
+        start = dispatched.pop(self._key(ctx),None)
+        if start is None:
+            return None
+        latency = time.time() - start
+        if name not in self._samples:
+            self._samples[name] = deque(maxlen=self._window)
+        self._samples[name].append(latency)
+        return latency
+
+    def percentile(self,name,p):
+        """
+        return the p-th percentile of the latency in seconds, None for not
+        enough samples
+        """
+        samples = self._samples.get(name,None)
+        if not samples or len(samples)<self._min_samples:
+            return None
+        samples = sorted(samples)
+        return samples[min(len(samples)-1, int(len(samples)*p/100))]
+
+
+class Histogram:
+    """
+    Fixed size latency histogram, with exponential buckets from 0.1ms to
+    about 20 minutes
+    """
+
+    bounds = [0.0001*(1.5**i) for i in range(41)]
+
+    def __init__(self):
+        self.buckets = [0]*(len(self.bounds)+1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self,seconds):
+        self.buckets[bisect.bisect_left(self.bounds,seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max,seconds)
+
+    def percentile(self,p):
+        """
+        upper bound of the bucket of the p-th percentile, in seconds
+        """
+        if not self.count:
+            return 0
+        rank = self.count*p/100
+        cnt = 0
+        for i,n in enumerate(self.buckets):
+            cnt += n
+            if cnt>=rank and n:
+                if i<len(self.bounds):
+                    return min(self.bounds[i],self.max)
+                return self.max
+        return self.max
+
+
+class Stats:
+    """
+    Histograms of each pipeline stage, per source for the source specific
+    stages, and counters of events
+    """
+
+    # in the order of the pipeline
+    stages = ['scoping','dispatch','compute','latency','process','merge','core_complete']
+
+    def __init__(self):
+        # { (stage, source): Histogram }
+        self._histograms = {}
+        # { (event, source): count }
+        self._counters = {}
+
+    def record(self,stage,seconds,source=''):
+        key = (stage,source)
+        if key not in self._histograms:
+            self._histograms[key] = Histogram()
+        self._histograms[key].record(seconds)
+
+    def count(self,event,source=''):
+        key = (event,source)
+        self._counters[key] = self._counters.get(key,0)+1
+
+    def report(self):
+        """
+        return lines of text
+        """
+        def order(key):
+            stage,source = key
+            if stage in self.stages:
+                return (self.stages.index(stage),source)
+            return (len(self.stages),stage,source)
+
+        lines = ['%-14s %-16s %8s %9s %9s %9s %9s' % ('stage','source','count','p50(ms)','p95(ms)','p99(ms)','max(ms)')]
+        for key in sorted(self._histograms.keys(),key=order):
+            h = self._histograms[key]
+            lines.append('%-14s %-16s %8d %9.1f %9.1f %9.1f %9.1f' % (key[0], key[1] or '-', h.count,
+                         h.percentile(50)*1000, h.percentile(95)*1000, h.percentile(99)*1000, h.max*1000))
+        if self._counters:
+            lines.append('')
+            lines.append('%-14s %-16s %8s' % ('event','source','count'))
+            for key in sorted(self._counters.keys()):
+                lines.append('%-14s %-16s %8d' % (key[0], key[1] or '-', self._counters[key]))
+        return lines
+
+
+class ScopeCache:
+    """
+    Regions detected by the scopers implementing `regions(ctx,src)`, for each
+    (scoper, parent scope, bufnr). The regions are reused while only the
+    cursor moves, and shifted for the edits that don't cross a region
+    boundary, instead of parsing the source on every keystroke.
+
+    A region is a tuple of (scope, scope_offset, scope_len), sorted by
+    offset, not overlapping. The cursor at the end of a region is inside the
+    region, eg. typing at the end of `style="color: red|"`.
+
+    A scoper may implement `region_intact(region,old_src,new_src,change)`,
+    `region` is the region containing the edit, or None if the edit is
+    outside of the regions, `change` is from `cm.change_range`. Return False
+    if the edit may have changed the regions, eg. typing a fence in markdown.
+    Without it any edit reparses the source.
+    """
+
+    def __init__(self,stats,size=16):
+        self._stats = stats
+        self._size = size
+        # { key: dict(changedtick=, src=, regions=, offsets=) }
+        self._entries = OrderedDict()
+
+    def sub_context(self,scoper,ctx,src):
+        regions, offsets = self._regions(scoper,ctx,src)
+        pos = cm.get_pos(ctx['lnum'],ctx['col'],src)
+        i = bisect.bisect_right(offsets,pos)-1
+        if i<0:
+            return None
+        scope, offset, length = regions[i]
+        if pos>offset+length:
+            return None
+        return self._region_context(ctx,src,pos,regions[i])
+
+    def _regions(self,scoper,ctx,src):
+        name = scoper.__module__
+        key = (id(scoper),ctx['scope'],ctx['bufnr'])
+        entry = self._entries.get(key,None)
+        if entry is None:
+            entry = dict(changedtick=None, src=None, regions=None, offsets=None)
+            self._entries[key] = entry
+            if len(self._entries)>self._size:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+
+        if entry['changedtick']==ctx['changedtick'] and entry['src']==src:
+            # only the cursor moved, the text is compared too, the scopes of
+            # nested scopers are different slices at the same changedtick,
+            # eg. two html fences in markdown
+            self._stats.count('scope_cached',name)
+            return entry['regions'], entry['offsets']
+
+        regions = None
+        if entry['src'] is not None:
+            regions = self._shift(scoper,entry,src)
+        if regions is None:
+            self._stats.count('scope_parsed',name)
+            regions = sorted(scoper.regions(ctx,src),key=lambda e: e[1])
+        else:
+            self._stats.count('scope_shifted',name)
+
+        entry['changedtick'] = ctx['changedtick']
+        entry['src'] = src
+        entry['regions'] = regions
+        entry['offsets'] = [e[1] for e in regions]
+        return regions, entry['offsets']
+
+    def _shift(self,scoper,entry,src):
+        """
+        Adjust the regions for the edit, None if the source needs to be parsed
+        again
+        """
+        region_intact = getattr(scoper,'region_intact',None)
+        if region_intact is None:
+            return None
+        old_src = entry['src']
+        change = cm.change_range(old_src,src)
+        if change is None:
+            return entry['regions']
+        start, old_end, new_end = change
+        delta = new_end-old_end
+
+        regions = entry['regions']
+        i = bisect.bisect_right(entry['offsets'],start)-1
+        containing = None
+        if i>=0:
+            scope, offset, length = regions[i]
+            if old_end<=offset+length:
+                containing = regions[i]
+            elif start<=offset+length:
+                # crossing the end of the region
+                return None
+        if i+1<len(regions) and old_end>=regions[i+1][1]:
+            # crossing the start of the next region
+            return None
+
+        if not region_intact(containing,old_src,src,change):
+            return None
+
+        result = regions[:i+1] if containing is None else regions[:i]
+        if containing is not None:
+            scope, offset, length = containing
+            result.append((scope,offset,length+delta))
+        for scope, offset, length in regions[i+1:]:
+            result.append((scope,offset+delta,length))
+        return result
+
+    def _region_context(self,ctx,src,pos,region):
+        scope, offset, length = region
+        scope_lnum, scope_col = cm.get_lnum_col(offset,src)
+        lnum, col = cm.get_lnum_col(pos,src)
+        new_ctx = dict(ctx)
+        new_ctx['scope'] = scope
+        new_ctx['lnum'] = lnum-scope_lnum+1
+        if lnum==scope_lnum:
+            new_ctx['col'] = col-scope_col+1
+        else:
+            new_ctx['col'] = col
+        new_ctx['scope_offset'] = offset
+        new_ctx['scope_len'] = length
+        new_ctx['scope_lnum'] = scope_lnum
+        new_ctx['scope_col'] = scope_col
+        return new_ctx
+
+
+class CompleteServer(Thread):
+    """
+    Unix socket for the channel sources to push matches to the core, see
+    `cm.complete`. One json message per line, `[method, args]`.
+    """
+
+    def __init__(self):
+        self.address = None
+        self._dir = None
+        Thread.__init__(self)
+
+    def start(self,dispatch):
+        """
+        Start the complete server
+        @param dispatch  called with (method, args) on the connection thread
+        """
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        method, args = json.loads(line.decode('utf-8'))
+                        dispatch(method,args)
+                    except Exception as ex:
+                        logger.exception('exception on CompleteServer: %s', ex)
+
+        # private directory, only the current user could connect
+        self._dir = tempfile.mkdtemp(prefix='cm-core-')
+        self.address = os.path.join(self._dir,'complete.sock')
+        # not available on windows
+        self._server = socketserver.ThreadingUnixStreamServer(self.address, Handler)
+        self._server.daemon_threads = True
+
+        Thread.start(self)
+
+    def run(self):
+        logger.info('running complete server on %s, thread %s', self.address, threading.get_ident())
+        self._server.serve_forever()
+
+    def shutdown(self,wait=True):
+        """
+        Shutdown the complete server
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._dir,ignore_errors=True)
+        if wait:
+            self.join()
+
+
+class Zygote(Thread):
+    """
+    Client of the zygote process, which has the common modules imported, and
+    forks the channel sources on request, instead of starting a new
+    interpreter for each of them. The forked source connects to neovim by
+    v:servername, and reports its channel with cm#_channel_started. One json
+    message per line on the connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sock = None
+        # requests before the zygote is ready
+        self._pending = []
+        self._failed = False
+        self._dir = None
+        self._proc = None
+        Thread.__init__(self)
+        self.daemon = True
+
+    def start(self,servername,dispatch,timeout=5):
+        """
+        Start the zygote process
+        @param dispatch  called with the messages of the zygote, on the
+                         connection thread
+        """
+        self._servername = servername
+        self._dispatch = dispatch
+        self._timeout = timeout
+        self._dir = tempfile.mkdtemp(prefix='cm-core-')
+        self._address = os.path.join(self._dir,'zygote.sock')
+        env = dict(os.environ)
+        # the pythonx directories of the runtimepath
+        env['PYTHONPATH'] = os.pathsep.join([p for p in sys.path if p])
+        self._proc = subprocess.Popen([sys.executable,__file__,'zygote',self._address],
+                                      env=env,
+                                      stdin=subprocess.DEVNULL,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL)
+        Thread.start(self)
+
+    def fork(self,name,modulename):
+        request = dict(name=name,path=modulename,servername=self._servername,time=time.time())
+        with self._lock:
+            if self._failed:
+                self._dispatch(dict(failed=name))
+            elif self._sock is None:
+                self._pending.append(request)
+            else:
+                self._send(request)
+
+    def _send(self,request):
+        try:
+            self._sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        except Exception as ex:
+            logger.exception('sending request to zygote failed: %s', ex)
+            self._dispatch(dict(failed=request['name']))
+
+    def run(self):
+        # wait for the zygote to listen
+        deadline = time.time()+self._timeout
+        sock = None
+        while sock is None:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self._address)
+            except Exception as ex:
+                sock.close()
+                sock = None
+                if time.time()>deadline or self._proc.poll() is not None:
+                    logger.error('zygote is not available, fallback to jobstart: %s', ex)
+                    with self._lock:
+                        self._failed = True
+                        for request in self._pending:
+                            self._dispatch(dict(failed=request['name']))
+                        self._pending = []
+                    return
+                time.sleep(0.01)
+
+        logger.info('zygote connected, thread %s', threading.get_ident())
+        with self._lock:
+            self._sock = sock
+            for request in self._pending:
+                self._send(request)
+            self._pending = []
+
+        for line in sock.makefile('rb'):
+            try:
+                msg = json.loads(line.decode('utf-8'))
+                logger.info('zygote message: %s', msg)
+                self._dispatch(msg)
+            except Exception as ex:
+                logger.exception('exception on zygote message: %s', ex)
+
+        logger.info('zygote connection closed')
+        with self._lock:
+            self._failed = True
+            self._sock = None
+
+    def shutdown(self):
+        """
+        The zygote exits when the connection is closed, the forked sources
+        keep running until neovim exits
+        """
+        with self._lock:
+            self._failed = True
+            if self._sock:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
+                self._sock.close()
+        shutil.rmtree(self._dir,ignore_errors=True)
+
+
+class BufferMirror(Thread):
+    """
+    Line arrays of the buffers, kept up to date by the nvim_buf_attach line
+    events, so that reading a buffer is a local read instead of fetching the
+    whole buffer from neovim on every keystroke. This thread runs the event
+    loop of the connection, other threads use `call` for requests.
+    """
+
+    def __init__(self,nvim):
+        self._nvim = nvim
+        self._cond = threading.Condition()
+        # { bufnr: dict(lines=[], changedtick=, src=, mark=) }, changedtick is
+        # None before the lines of the buffer are received, src is joined on
+        # the first read and spliced by the later line events, mark is
+        # (lnum, offset) of a line start in src, near the last edit
+        self._buffers = {}
+        # False if nvim_buf_attach is not supported by neovim
+        self._supported = True
+        # detached buffers, the events are from the old attachment until the
+        # detach event
+        self._detaching = set()
+        Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        logger.info('running buffer mirror, thread %s', threading.get_ident())
+        self._nvim.run_loop(None, self._on_notification)
+
+    def stop(self):
+        self._nvim.async_call(self._nvim.stop_loop)
+
+    def call(self,fn,*args):
+        """
+        Run fn on the event loop thread, and wait for the result
+        """
+        result = {}
+        done = threading.Event()
+        def run():
+            try:
+                result['value'] = fn(*args)
+            except Exception as ex:
+                result['error'] = ex
+            finally:
+                done.set()
+        self._nvim.async_call(run)
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def get(self,bufnr,changedtick=None,timeout=0.05):
+        """
+        Return (changedtick, text) of the buffer, or None if it is not
+        available in the mirror, the buffer is attached for the later calls.
+        If changedtick is not None, the text at changedtick is returned, the
+        line events of a change may arrive a little later than the context,
+        wait for them at most timeout seconds.
+        """
+        if not self._supported:
+            return None
+        with self._cond:
+            buf = self._buffers.get(bufnr,None)
+            if buf is None:
+                self._buffers[bufnr] = dict(lines=[], changedtick=None, src=None, mark=None)
+                self._nvim.async_call(self._attach,bufnr)
+                return None
+            if changedtick is not None:
+                self._cond.wait_for(lambda: (self._buffers.get(bufnr,None) is not buf) or
+                                            (buf['changedtick'] is not None and buf['changedtick']>=changedtick),
+                                    timeout)
+            if self._buffers.get(bufnr,None) is not buf or buf['changedtick'] is None:
+                return None
+            if changedtick is not None and buf['changedtick']!=changedtick:
+                return None
+            if buf['src'] is None:
+                buf['src'] = "\n".join(buf['lines'])
+                buf['mark'] = (0, 0)
+            return buf['changedtick'], buf['src']
+
+    def detach(self,bufnr):
+        """
+        Stop mirroring the buffer, release the lines
+        """
+        with self._cond:
+            if self._buffers.pop(bufnr,None) is None:
+                return
+            self._detaching.add(bufnr)
+            self._cond.notify_all()
+        self._nvim.async_call(self._detach,bufnr)
+
+    def _attach(self,bufnr):
+        try:
+            ok = self._nvim.request('nvim_buf_attach', bufnr, True, {})
+        except Exception as ex:
+            logger.exception('nvim_buf_attach failed, fetch the whole buffer instead: %s', ex)
+            self._supported = False
+            ok = False
+        if not ok:
+            with self._cond:
+                self._buffers.pop(bufnr,None)
+                self._cond.notify_all()
+
+    def _detach(self,bufnr):
+        try:
+            ok = self._nvim.request('nvim_buf_detach', bufnr)
+        except Exception as ex:
+            # the buffer is wiped out
+            logger.info('nvim_buf_detach [%s] failed: %s', bufnr, ex)
+            ok = False
+        if not ok:
+            # no detach event
+            with self._cond:
+                self._detaching.discard(bufnr)
+
+    def _on_notification(self,method,args):
+        if method not in ['nvim_buf_lines_event','nvim_buf_changedtick_event','nvim_buf_detach_event']:
+            return
+        bufnr = getattr(args[0],'number',args[0])
+        with self._cond:
+            if bufnr in self._detaching:
+                if method=='nvim_buf_detach_event':
+                    self._detaching.discard(bufnr)
+                return
+            buf = self._buffers.get(bufnr,None)
+            if buf is None:
+                return
+            if method=='nvim_buf_lines_event':
+                changedtick, first, last, linedata, more = args[1:6]
+                if changedtick is None:
+                    # preview lines of 'inccommand', the buffer is not changed
+                    return
+                if last<0:
+                    last = len(buf['lines'])
+                if buf['src'] is not None:
+                    self._splice(buf,first,last,linedata)
+                buf['lines'][first:last] = linedata
+            elif method=='nvim_buf_changedtick_event':
+                changedtick = args[1]
+            else:
+                logger.info('buffer [%s] detached', bufnr)
+                del self._buffers[bufnr]
+                changedtick = None
+            if changedtick is not None:
+                buf['changedtick'] = changedtick
+            self._cond.notify_all()
+
+    def _splice(self,buf,first,last,linedata):
+        """
+        Replace lines [first,last) in src, before they're replaced in lines,
+        the offset of the first line is counted from the mark
+        """
+        lines, src = buf['lines'], buf['src']
+        lnum, mark = buf['mark']
+        if first>=lnum:
+            mark += sum(len(line)+1 for line in islice(lines,lnum,first))
+        else:
+            mark -= sum(len(line)+1 for line in islice(lines,first,lnum))
+        start = mark
+        end = start + sum(len(line)+1 for line in islice(lines,first,last))
+        text = "\n".join(linedata)
+        if last<len(lines):
+            # the newline of the last replaced line is kept
+            if linedata:
+                text += "\n"
+        elif first==last:
+            # appending lines, after the newline of the old last line
+            if linedata and first:
+                text = "\n" + text
+            start = end = len(src)
+        else:
+            # replacing the last lines, which have no trailing newline
+            end -= 1
+            if not linedata and first:
+                start -= 1
+        buf['src'] = src[:start] + text + src[end:]
+        buf['mark'] = (first, mark)
 
 
 # Cached file content in memory, and use http protocol to serve files, instead
@@ -445,11 +1540,17 @@ class CoreHandler:
 # markdown code fences.
 class FileServer(Thread):
 
-    def __init__(self):
+    def __init__(self,cache_size=16*1024*1024):
         self._rlock = RLock()
         self._current_context = None
-        self._cache_context = None
-        self._cache_src = ""
+        # { bufnr: dict(changedtick=, src=) }, in LRU order, the total length
+        # of the sources is limited to cache_size characters
+        self._snapshots = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_used = 0
+        self.address = None
+        self._dir = None
+        self._unix_server = None
         Thread.__init__(self)
 
     def start(self,nvim_server_name):
@@ -474,12 +1575,34 @@ class FileServer(Thread):
 
         # create another connection to avoid synchronization issue?
         self._nvim = attach('socket',path=nvim_server_name)
+        self._mirror = BufferMirror(self._nvim)
+        self._mirror.start()
 
         # Server settings
         # 0 for random port
         server_address = ('127.0.0.1', 0)
         self._httpd = HTTPServer(server_address, HttpHandler)
 
+        class UnixHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    server.run_unix(self,line)
+
+        # The unix socket transport, one json context per line, replied with
+        # a json header line and the utf-8 source. The connection is kept by
+        # the client, without the http parsing and the connection setup of
+        # each request.
+        try:
+            self._dir = tempfile.mkdtemp(prefix='cm-core-')
+            address = os.path.join(self._dir,'src.sock')
+            self._unix_server = socketserver.ThreadingUnixStreamServer(address, UnixHandler)
+            self._unix_server.daemon_threads = True
+            Thread(target=self._unix_server.serve_forever,daemon=True).start()
+            self.address = address
+        except Exception as ex:
+            # not available on windows, src_uri still works
+            logger.exception('failed starting unix socket of FileServer: %s', ex)
+
         Thread.start(self)
 
     def run_GET(self,request):
@@ -491,45 +1614,161 @@ class FileServer(Thread):
 
         params = {}
         for e in urllib.parse.parse_qsl(urllib.parse.urlparse(request.path).query):
-            params[e[0]] = e[1]
+            params[e[0]] = json.loads(e[1])
         
         logger.info('thread %s processing %s', threading.get_ident(), params)
 
-        context = json.loads(params['context'])
-        src = self.get_src(context)
-        if src is None:
-            src = ""
+        src, etag = self._get_params(params)
+
+        if etag and request.headers.get('If-None-Match')==etag:
+            request.send_response(304)
+            request.send_header('ETag',etag)
+            request.end_headers()
+            return
 
         request.send_response(200)
         request.send_header('Content-type','text/html')
+        if etag:
+            request.send_header('ETag',etag)
         request.end_headers()
         request.wfile.write(bytes(src, "utf8"))
 
+    def run_unix(self,request,line):
+        """
+        Process one request line of the unix socket transport
+        @type request: socketserver.StreamRequestHandler
+        """
+        try:
+            # the same parameters as the http query
+            params = json.loads(line.decode('utf-8'))
+            src, etag = self._get_params(params)
+            if etag and params.get('etag')==etag:
+                body = b''
+                header = dict(length=0,etag=etag,not_modified=1)
+            else:
+                body = src.encode('utf-8')
+                header = dict(length=len(body),etag=etag)
+        except Exception as ex:
+            logger.exception('exception on FileServer: %s', ex)
+            body = b''
+            header = dict(error=str(ex))
+        request.wfile.write((json.dumps(header) + "\n").encode('utf-8') + body)
+
     def run(self):
         logger.info('running server on port %s, thread %s', self._httpd.server_port, threading.get_ident())
         self._httpd.serve_forever()
 
-    def get_src(self,context):
+    def _get_params(self,params):
+        if 'bufnr' in params:
+            return self.get_buffer_etag(params['bufnr'],params.get('lines'),params.get('bytes'))
+        return self.get_src_etag(params['context'],params.get('lines'),params.get('bytes'))
+
+    def get_src(self,context,lines=None,byte_range=None):
+        src, etag = self.get_src_etag(context,lines,byte_range)
+        if etag is None:
+            return None
+        return src
+
+    def get_src_etag(self,context,lines=None,byte_range=None):
+        """
+        Return (src, etag), the etag identifies the buffer snapshot, it's None
+        and src is "" for outdated context.
+        @param lines  [first, last], 1 based and inclusive, relative to the scope
+        @param byte_range  [start, end] of the utf-8 encoded scope, partial
+                           characters at the ends are dropped
+        """
 
         with self._rlock:
 
             # If context does not match current context, check the neovim current
             # context, if does not match neither, return None
             if cm.context_outdated(self._current_context,context):
-                self._current_context = self._nvim.eval('cm#context()')
+                self._current_context = self._mirror.call(self._nvim.eval,'cm#context()')
             if cm.context_outdated(self._current_context,context):
                 logger.info('get_src returning None for oudated context: %s', context)
-                return None
+                return "", None
 
-            # update cache when necessary
-            if cm.context_outdated(self._current_context, self._cache_context):
-                logger.info('get_src updating cache for context %s', context)
-                self._cache_context = self._current_context
-                self._cache_src = "\n".join(self._nvim.current.buffer[:])
+            bufnr = self._current_context['bufnr']
+            changedtick, src = self._snapshot(bufnr,self._current_context['changedtick'])
+            etag = '"%s.%s"' % (bufnr,changedtick)
+            return self._slice(src,context.get('scope_offset',0),context.get('scope_len',None),lines,byte_range), etag
 
-            scope_offset = context.get('scope_offset',0)
-            scope_len = context.get('scope_len',len(self._cache_src))
-            return self._cache_src[scope_offset:scope_offset+scope_len]
+    def get_buffer_etag(self,bufnr,lines=None,byte_range=None):
+        """
+        Return (src, etag) of the latest snapshot of any buffer, not checked
+        against the current context
+        """
+        with self._rlock:
+            changedtick, src = self._snapshot(bufnr,None)
+            etag = '"%s.%s"' % (bufnr,changedtick)
+            return self._slice(src,0,None,lines,byte_range), etag
+
+    def _snapshot(self,bufnr,changedtick):
+        """
+        Return (changedtick, src) of the buffer, at changedtick if it's not
+        None, from the cache, the mirror, or neovim
+        """
+        snapshot = self._snapshots.get(bufnr,None)
+        if snapshot and (changedtick is None or snapshot['changedtick']==changedtick):
+            if changedtick is None:
+                # the mirror may have a newer one
+                mirrored = self._mirror.get(bufnr)
+                if mirrored and mirrored[0]!=snapshot['changedtick']:
+                    snapshot = None
+            if snapshot:
+                self._snapshots.move_to_end(bufnr)
+                return snapshot['changedtick'], snapshot['src']
+
+        mirrored = self._mirror.get(bufnr,changedtick)
+        if mirrored is None:
+            logger.info('get_src updating cache for buffer [%s]', bufnr)
+            def fetch():
+                return (self._nvim.request('nvim_buf_get_var',bufnr,'changedtick'),
+                        self._nvim.request('nvim_buf_get_lines',bufnr,0,-1,True))
+            tick, lines = self._mirror.call(fetch)
+            mirrored = (changedtick if changedtick is not None else tick), "\n".join(lines)
+
+        old = self._snapshots.pop(bufnr,None)
+        if old:
+            self._cache_used -= len(old['src'])
+        self._snapshots[bufnr] = dict(changedtick=mirrored[0],src=mirrored[1])
+        self._cache_used += len(mirrored[1])
+
+        # LRU eviction, the latest is always kept
+        while self._cache_used>self._cache_size and len(self._snapshots)>1:
+            evicted, snapshot = self._snapshots.popitem(last=False)
+            self._cache_used -= len(snapshot['src'])
+            logger.info('evicting buffer [%s] from cache', evicted)
+            self._mirror.detach(evicted)
+
+        return mirrored
+
+    def _slice(self,src,scope_offset,scope_len,lines,byte_range):
+        """
+        The scope of src, narrowed by lines and byte_range
+        """
+        scope_end = len(src)
+        if scope_len is not None:
+            scope_end = min(scope_offset+scope_len,scope_end)
+
+        if lines:
+            index = cm.get_line_index(src)
+            scope_lnum = index.lnum_col(scope_offset)[0]
+            first = max(lines[0],1)+scope_lnum-1
+            last = max(lines[1]+scope_lnum-1,scope_lnum-1)
+            start = scope_offset
+            if first>scope_lnum:
+                start = index.pos(first,1) if first<=index.lines else scope_end
+            end = scope_end
+            if last<index.lines:
+                # excluding the newline
+                end = index.pos(last+1,1)-1
+            scope_offset, scope_end = max(start,scope_offset), max(min(end,scope_end),start)
+
+        src = src[scope_offset:scope_end]
+        if byte_range:
+            src = src.encode('utf-8')[byte_range[0]:byte_range[1]].decode('utf-8','ignore')
+        return src
 
     def set_current_ctx(self,context):
         """
@@ -540,7 +1779,7 @@ class FileServer(Thread):
 
     def get_src_uri(self,context):
         # changedtick and curpos is enough for outdating check
-        stripped = dict(changedtick=context['changedtick'],curpos=context['curpos'])
+        stripped = dict(bufnr=context['bufnr'],changedtick=context['changedtick'],curpos=context['curpos'])
         if 'scope_offset' in context:
             stripped['scope_offset'] = context['scope_offset']
         if 'scope_len' in context:
@@ -553,6 +1792,12 @@ class FileServer(Thread):
         Shutdown the file server
         """
         self._httpd.shutdown()
+        if self._unix_server:
+            self._unix_server.shutdown()
+            self._unix_server.server_close()
+        if self._dir:
+            shutil.rmtree(self._dir,ignore_errors=True)
+        self._mirror.stop()
         if wait:
             self.join()
 
@@ -603,6 +1848,52 @@ def main():
             # terminate here
             exit(0)
 
+    elif start_type == 'host':
+
+        setup_logging('cm_host')
+        logger = logging.getLogger(__name__)
+        logger.setLevel(get_loglevel())
+
+        # change proccess title
+        try:
+            import setproctitle
+            setproctitle.setproctitle('nvim-completion-manager host')
+        except:
+            pass
+
+        try:
+            # connect neovim
+            nvim = nvim_env()
+            host = SourceHost(nvim)
+            logger.info('starting host, enter event loop')
+            cm_event_loop('host',logger,nvim,host)
+        except Exception as ex:
+            logger.exception('Exception when running host: %s',ex)
+            exit(1)
+        finally:
+            # terminate here
+            exit(0)
+
+    elif start_type == 'zygote':
+
+        setup_logging('cm_zygote')
+        logger = logging.getLogger(__name__)
+        logger.setLevel(get_loglevel())
+
+        try:
+            import setproctitle
+            setproctitle.setproctitle('nvim-completion-manager zygote')
+        except:
+            pass
+
+        try:
+            zygote_loop(logger,sys.argv[2])
+        except Exception as ex:
+            logger.exception('Exception when running zygote: %s',ex)
+            exit(1)
+        finally:
+            exit(0)
+
     elif start_type == 'channel':
 
         name = sys.argv[2]
@@ -634,6 +1925,149 @@ def main():
             # terminate here
             exit(0)
 
+class SourceHost:
+    """
+    Runs several python sources in one process, to save the interpreter
+    startup, the imports and the memory of a process per source. Each source
+    runs on its own thread, with its own connection to neovim, so that a slow
+    source does not block the others, and neovim talks to it the same way as
+    a source channel.
+    """
+
+    def __init__(self,nvim):
+        self._nvim = nvim
+        self._servername = nvim.eval('v:servername')
+
+    def cm_host_start(self,name,modulename):
+        thread = threading.Thread(target=self._run_source,args=(name,modulename),
+                                  name=modulename,daemon=True)
+        thread.start()
+
+    def _run_source(self,name,modulename):
+        logger = logging.getLogger(modulename)
+        logger.setLevel(get_loglevel())
+        try:
+            nvim = attach('socket',path=self._servername)
+            m = importlib.import_module(modulename)
+            handler = m.Source(nvim)
+            channel_id = nvim.request('nvim_get_api_info')[0]
+            nvim.call('cm#_channel_started',name,channel_id,async=True)
+            logger.info('handler created on channel %s, entering event loop', channel_id)
+            cm_event_loop('channel',logger,nvim,handler)
+        except Exception as ex:
+            logger.exception('Exception: %s',ex)
+        finally:
+            self._nvim.async_call(lambda: self._nvim.call('cm#_channel_exited',name,async=True))
+
+
+# imported by the zygote, shared by the forked sources
+zygote_preload = ['cm.cm', 'http.client', 'asyncio', 'greenlet', 'msgpack']
+
+def zygote_loop(logger,address):
+    """
+    Serve the fork requests of the core, report the exits of the forked
+    sources. Only one connection, the zygote exits with the core.
+    """
+    for modulename in zygote_preload:
+        try:
+            importlib.import_module(modulename)
+        except Exception as ex:
+            logger.info('preloading %s failed: %s', modulename, ex)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen(1)
+    conn, _ = server.accept()
+    logger.info('core connected')
+
+    # SIGCHLD wakes up the select through the self-pipe, instead of polling
+    # for the exited sources
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r,False)
+    os.set_blocking(wakeup_w,False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD,lambda signum, frame: None)
+
+    # { pid: name }
+    children = {}
+    buf = b''
+    while True:
+        readable, _, _ = select.select([conn, wakeup_r],[],[])
+
+        if wakeup_r in readable:
+            try:
+                while os.read(wakeup_r,4096):
+                    pass
+            except BlockingIOError:
+                pass
+            # reap the forked sources
+            while children:
+                pid, status = os.waitpid(-1,os.WNOHANG)
+                if pid==0:
+                    break
+                name = children.pop(pid,None)
+                logger.info('source [%s] pid %s exited, status %s', name, pid, status)
+                conn.sendall((json.dumps(dict(exited=name,pid=pid)) + "\n").encode('utf-8'))
+
+        if conn not in readable:
+            continue
+        data = conn.recv(4096)
+        if not data:
+            logger.info('core disconnected')
+            return
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n',1)
+            request = json.loads(line.decode('utf-8'))
+            pid = os.fork()
+            if pid==0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD,signal.SIG_DFL)
+                os.close(wakeup_r)
+                os.close(wakeup_w)
+                server.close()
+                conn.close()
+                zygote_child(request)
+            children[pid] = request['name']
+            logger.info('source [%s] forked, pid %s', request['name'], pid)
+
+def zygote_child(request):
+    """
+    Run the forked source, never returns
+    """
+    forked = time.time()
+    name, modulename = request['name'], request['path']
+
+    # the log file of the source, instead of the zygote one
+    for handler in list(logging.root.handlers):
+        logging.root.removeHandler(handler)
+    setup_logging(modulename)
+    logger = logging.getLogger(modulename)
+    logger.setLevel(get_loglevel())
+    try:
+        import setproctitle
+        setproctitle.setproctitle('nvim-completion-manager %s' % modulename)
+    except:
+        pass
+
+    try:
+        nvim = attach('socket',path=request['servername'])
+        connected = time.time()
+        m = importlib.import_module(modulename)
+        imported = time.time()
+        handler = m.Source(nvim)
+        created = time.time()
+        nvim.call('cm#_channel_started',name,nvim.request('nvim_get_api_info')[0],os.getpid())
+        logger.info('startup %.1fms, fork %.1fms, connect %.1fms, import %.1fms, init %.1fms',
+                    (time.time()-request['time'])*1000, (forked-request['time'])*1000,
+                    (connected-forked)*1000, (imported-connected)*1000, (created-imported)*1000)
+        cm_event_loop('channel',logger,nvim,handler)
+    except Exception as ex:
+        logger.exception('Exception: %s',ex)
+        os._exit(1)
+    os._exit(0)
+
+
 def nvim_env():
     nvim = attach('stdio')
     # setup pythonx
@@ -670,19 +2104,90 @@ def cm_event_loop(type,logger,nvim,handler):
             logger.info('method: %s not implemented, ignore this request', method)
             return None
 
-        func(*args)
+        return func(*args)
+
+    # source info cached by name, neovim only sends it again when the
+    # registry has changed
+    infos = {}
+
+    # The refresh calculation may be heavy, the notifications received while
+    # a source is busy are queued, and dispatched by `drain`, which runs after
+    # all the notifications of the same read. A refresh is dropped without
+    # any work, if it's superseded by a newer refresh of the same source, or
+    # outdated by a newer context, the replies of the refreshes not dropped
+    # are still checked by the core.
+    queue = deque()
+    # { name: args of the newest cm_refresh_batch in the queue }
+    newest = {}
+    # the newest context received, [ctx]
+    latest = [None]
+    draining = [False]
 
     def on_notification(method, args):
         logger.debug('%s method: %s, args: %s', type, method, args)
 
-        if type=='channel' and method=='cm_refresh':
-            ctx = args[1]
-            # The refresh calculation may be heavy, and the notification queue
-            # may have outdated refresh events, it would be  meaningless to
-            # process these event
-            if nvim.call('cm#context_changed',ctx):
-                logger.info('context_changed, ignoring context: %s', ctx)
+        if type!='channel':
+            dispatch(method, args)
+            return
+
+        if method=='cm_refresh_batch':
+            name,info,ctxs = args[0:3]
+            if info:
+                infos[name] = info
+            newest[name] = args
+            latest[0] = ctxs[0]
+        elif method=='cm_event' and len(args)>1 and isinstance(args[1],dict) and 'changedtick' in args[1]:
+            latest[0] = args[1]
+
+        queue.append((method,args))
+        if not draining[0]:
+            draining[0] = True
+            nvim.async_call(drain)
+
+    def drain():
+        draining[0] = False
+        while queue:
+            method, args = queue.popleft()
+            if method=='cm_refresh_batch':
+                name,info,ctxs = args[0:3]
+                if newest.get(name,None) is not args:
+                    logger.info('superseded, ignoring contexts: %s', ctxs)
+                    cm.refresh_done(nvim,name,ctxs[0],1)
+                    continue
+                del newest[name]
+                # The contexts in a batch share the same root context,
+                # checking the first one is enough.
+                if cm.context_outdated(ctxs[0],latest[0]):
+                    logger.info('context_changed, ignoring contexts: %s', ctxs)
+                    cm.refresh_done(nvim,name,ctxs[0],1)
+                    continue
+            try:
+                dispatch(method, args)
+            except Exception as ex:
+                logger.exception('%s method %s failed: %s', type, method, ex)
+
+    def dispatch(method, args):
+
+        if type=='channel' and method=='cm_refresh_batch':
+            name,info,ctxs = args[0:3]
+            info = infos.get(name,None)
+            if info is None:
+                logger.error('no source info for [%s], ignoring the refresh', name)
                 return
+            deferred = False
+            try:
+                for ctx in ctxs:
+                    # for the compute time in the stats of the core
+                    ctx['refresh_start'] = time.time()
+                    if handler.cm_refresh(info,ctx) is not None:
+                        # the token of cm.RefreshWorker, which acknowledges
+                        # the refresh when it's finished
+                        deferred = True
+            finally:
+                if not deferred:
+                    cm.refresh_done(nvim,name,ctxs[0])
+            logger.debug('%s method %s completed', type, method)
+            return
 
         func = getattr(handler,method,None)
         if func is None:
@@ -701,5 +2206,7 @@ def cm_event_loop(type,logger,nvim,handler):
         func()
 
 
-main()
+# bench/cm_bench.py imports this module
+if __name__ == '__main__':
+    main()
 